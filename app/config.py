@@ -29,12 +29,19 @@ class Settings(BaseSettings):
     redis_port: int = Field(6379, alias="REDIS_PORT")
     redis_db: int = Field(0, alias="REDIS_DB")
     redis_password: str = Field("", alias="REDIS_PASSWORD")
+    # Путь к Unix-сокету Redis (предпочтительно при размещении на одном хосте); пусто = TCP
+    redis_socket_path: str = Field("", alias="REDIS_SOCKET_PATH")
+    redis_max_connections: int = Field(50, alias="REDIS_MAX_CONNECTIONS")
     
     # Environment
     env: str = Field("development", alias="ENV")
     
     # Logging
     log_level: str = Field("INFO", alias="LOG_LEVEL")
+    # JSON-лог в файл (через очередь loguru); при заданном пути консоль пишет только WARNING+
+    log_file: str = Field("", alias="LOG_FILE")
+    # Доля входящих апдейтов, попадающих в INFO-лог LoggingMiddleware (1.0 = все)
+    log_sample_rate: float = Field(1.0, alias="LOG_SAMPLE_RATE")
 
     # OpenAI
     openai_api_key: str = Field("", alias="OPENAI_API_KEY")
@@ -55,6 +62,9 @@ class Settings(BaseSettings):
     openai_stt_response_format: str = Field("text", alias="OPENAI_STT_RESPONSE_FORMAT")  # text | json
     openai_stt_language: str = Field("ru", alias="OPENAI_STT_LANGUAGE")  # например "ru" | "en"; пусто = авто
     openai_stt_prompt: str = Field("", alias="OPENAI_STT_PROMPT")
+    # Ограничение нагрузки на OpenAI: одновременные запросы и запросы в минуту
+    openai_max_concurrency: int = Field(16, alias="OPENAI_MAX_CONCURRENCY")
+    openai_rpm: int = Field(500, alias="OPENAI_RPM")
     # Включение и настройка web_search
     openai_enable_web_search: bool = Field(False, alias="OPENAI_ENABLE_WEB_SEARCH")
     openai_web_search_context_size: str = Field(
@@ -72,6 +82,8 @@ class Settings(BaseSettings):
     
     # Conversation memory
     conversation_max_history_messages: int = Field(20, alias="CONV_MAX_HISTORY_MESSAGES")
+    # Суммаризация истории через OpenAI Batch API: вдвое дешевле, сводка обновляется с задержкой
+    openai_summary_batch_enabled: bool = Field(False, alias="OPENAI_SUMMARY_BATCH_ENABLED")
     openai_prompt_cache_key: str = Field(
         "tersan-assistant-v1",
         alias="OPENAI_PROMPT_CACHE_KEY",
@@ -112,6 +124,9 @@ class Settings(BaseSettings):
     @property
     def redis_url(self) -> str:
         """Формирование URL для подключения к Redis"""
+        if self.redis_socket_path:
+            auth = f":{self.redis_password}@" if self.redis_password else ""
+            return f"unix://{auth}{self.redis_socket_path}?db={self.redis_db}"
         if self.redis_password:
             return f"redis://:{self.redis_password}@{self.redis_host}:{self.redis_port}/{self.redis_db}"
         return f"redis://{self.redis_host}:{self.redis_port}/{self.redis_db}"
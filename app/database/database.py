@@ -2,11 +2,12 @@
 Класс для работы с базой данных
 """
 from datetime import datetime
-from typing import Optional, List
+from typing import AsyncIterator, Iterable, Optional, List, Tuple
 import secrets
 from datetime import datetime
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
-from sqlalchemy import select, func, update
+from sqlalchemy import select, func, update, true
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from loguru import logger
 
 from app.config import settings
@@ -83,6 +84,80 @@ class Database:
             await session.refresh(user)
             return user
     
+    async def upsert_and_fetch_user(
+        self,
+        user_id: int,
+        username: Optional[str] = None,
+        first_name: Optional[str] = None,
+        last_name: Optional[str] = None,
+        *,
+        force_admin: bool = False,
+        force_active: bool = False,
+    ) -> Tuple[bool, bool]:
+        """Создание/обновление пользователя одним запросом. Возвращает (is_active, is_admin).
+
+        force_admin выдаёт права администратора и доступ, force_active — только доступ.
+        Уже выданные права не снимаются.
+        """
+        now = datetime.utcnow()
+        grant_active = force_active or force_admin
+        stmt = pg_insert(User).values(
+            id=user_id,
+            username=username,
+            first_name=first_name,
+            last_name=last_name,
+            is_active=grant_active,
+            is_admin=force_admin,
+        )
+        set_: dict = {
+            "username": stmt.excluded.username,
+            "first_name": stmt.excluded.first_name,
+            "last_name": stmt.excluded.last_name,
+            "updated_at": now,
+        }
+        if grant_active:
+            set_["is_active"] = true()
+        if force_admin:
+            set_["is_admin"] = true()
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.id],
+            set_=set_,
+        ).returning(User.is_active, User.is_admin)
+        async with self.session_maker() as session:
+            result = await session.execute(stmt)
+            row = result.one()
+            await session.commit()
+            return bool(row.is_active), bool(row.is_admin) or settings.is_admin(user_id)
+
+    async def bulk_upsert_users(
+        self, rows: Iterable[Tuple[int, Optional[str], Optional[str], Optional[str]]]
+    ) -> int:
+        """Пакетное создание/обновление пользователей одним INSERT ... ON CONFLICT.
+
+        rows: кортежи (user_id, username, first_name, last_name); user_id должны быть уникальны.
+        Права доступа не меняются. Возвращает число переданных строк.
+        """
+        values = [
+            {"id": user_id, "username": username, "first_name": first_name, "last_name": last_name}
+            for user_id, username, first_name, last_name in rows
+        ]
+        if not values:
+            return 0
+        stmt = pg_insert(User).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.id],
+            set_={
+                "username": stmt.excluded.username,
+                "first_name": stmt.excluded.first_name,
+                "last_name": stmt.excluded.last_name,
+                "updated_at": datetime.utcnow(),
+            },
+        )
+        async with self.session_maker() as session:
+            await session.execute(stmt)
+            await session.commit()
+        return len(values)
+
     async def get_user(self, user_id: int) -> Optional[User]:
         """Получение пользователя по ID"""
         async with self.session_maker() as session:
@@ -100,6 +175,26 @@ class Database:
             result = await session.execute(select(User).where(User.is_active == True))
             return result.scalars().all()
 
+    async def stream_active_users(self, batch_size: int = 500) -> AsyncIterator[User]:
+        """Постраничное чтение активных пользователей (keyset по id, batch_size строк на страницу)
+
+        Каждая страница читается в отдельной короткой сессии: рассылка может идти час,
+        и держать всё это время соединение из пула и открытую транзакцию нельзя.
+        """
+        last_id: Optional[int] = None
+        while True:
+            query = select(User).where(User.is_active == True)
+            if last_id is not None:
+                query = query.where(User.id > last_id)
+            async with self.session_maker() as session:
+                result = await session.execute(query.order_by(User.id).limit(batch_size))
+                users = result.scalars().all()
+            for user in users:
+                yield user
+            if len(users) < batch_size:
+                return
+            last_id = users[-1].id
+
     async def set_user_access(self, user_id: int, is_active: bool) -> Optional[User]:
         """Установка доступа пользователю"""
         async with self.session_maker() as session:
@@ -13,7 +13,7 @@ from loguru import logger
 from app.config import settings
 from app.database import db
 from app.states import AdminStates
-from app.keyboards import AdminKeyboards
+from app.keyboards import AdminKeyboards, AdminUserCB
 from app.services import BroadcastService
 from app.services.openai_service import openai_service
 
@@ -120,29 +120,19 @@ async def admin_users_list(callback: CallbackQuery):
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("admin_user_"))
-async def admin_user_card(callback: CallbackQuery):
+@router.callback_query(AdminUserCB.filter())
+async def admin_user_card(callback: CallbackQuery, callback_data: AdminUserCB):
     """Карточка пользователя"""
     if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Нет прав")
         return
-    data = callback.data or ""
-    # варианты: admin_user_<id>, admin_user_grant_<id>, admin_user_revoke_<id>, admin_user_make_admin_<id>
-    parts = data.split("_")
-    action = parts[2]
-    user_id_str = parts[-1]
-    try:
-        target_user_id = int(user_id_str)
-    except ValueError:
-        await callback.answer("Некорректный ID")
-        return
+    target_user_id = callback_data.user_id
     # Выполним действие если нужно
-    if action == "grant":
+    if callback_data.action == "grant":
         await db.set_user_access(target_user_id, True)
-    elif action == "revoke":
+    elif callback_data.action == "revoke":
         await db.set_user_access(target_user_id, False)
-    elif action == "make":
-        # next part is 'admin'
+    elif callback_data.action == "make_admin":
         await db.set_user_admin(target_user_id, True)
     # Загружаем карточку
     u = await db.get_user(target_user_id)
@@ -210,7 +200,7 @@ async def set_docs_store(message: Message):
     if action == "create":
         name = args[2] if len(args) >= 3 else "tersan_docs"
         try:
-            vs_id = openai_service.create_vector_store(name)
+            vs_id = await openai_service.create_vector_store(name)
             openai_service.set_vector_store(vs_id)
             await message.answer(f"✅ Vector store создан и активирован: <code>{vs_id}</code>")
         except Exception as e:
@@ -248,7 +238,7 @@ async def docs_upload(message: Message):
     local_path = f"/tmp/{message.document.file_unique_id}.pdf"
     await message.bot.download_file(file_path, destination=local_path)
 
-    file_id = openai_service.upload_pdf(local_path)
+    file_id = await openai_service.upload_pdf(local_path)
     if file_id:
         await message.answer("✅ Документ загружен в базу знаний")
     else:
@@ -3,43 +3,67 @@
 """
 import os
 from contextlib import suppress
+from pathlib import Path
 import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 from aiogram import Router, F
 from aiogram.enums import ChatAction
+from aiogram.exceptions import TelegramAPIError
 from aiogram.types import Message
 from aiogram.utils.chat_action import ChatActionSender
 from loguru import logger
+from openai import OpenAIError
 
 from app.services.openai_service import openai_service
 from app.services.audio import convert_to_wav
 from app.services.memory import memory
 from app.config import settings
 import time
-import mimetypes
 from app.database import db
 
 
 router = Router(name="qa")
 
+MediaProcessor = Callable[[Message, str, str, List[str]], Awaitable[None]]
+
+# Расширения для MIME-типов, которые реально приходят документами (без обращения к mimetypes)
+_EXT_BY_MIME = {
+    "application/pdf": ".pdf",
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+    "audio/ogg": ".oga",
+    "audio/mpeg": ".mp3",
+    "audio/mp4": ".m4a",
+    "audio/wav": ".wav",
+}
+
 
 async def _typing_heartbeat(bot, chat_id, period: float = 4.0):
     """Периодически шлём ChatAction.TYPING, пока задача не отменена."""
     try:
         while True:
-            with suppress(Exception):
+            with suppress(TelegramAPIError):
                 await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
             await asyncio.sleep(max(1.0, float(period)))
     except asyncio.CancelledError:
         return
 
 
+async def _check_access(message: Message) -> bool:
+    """Разрешаем только активным пользователям или админам; иначе сообщаем о закрытом доступе."""
+    db_user = await db.get_user(message.from_user.id)
+    if db_user and (db_user.is_active or await db.is_user_admin(message.from_user.id)):
+        return True
+    await message.answer("🚫 Доступ к функциям бота закрыт. Получите приглашение у администратора.")
+    return False
+
+
 @router.message(F.text & ~F.text.startswith("/"))
 async def qa_handler(message: Message) -> None:
     """Отвечаем на свободные текстовые вопросы, используя file_search при наличии."""
-    # Проверка доступа: разрешаем только активным пользователям или админам
-    db_user = await db.get_user(message.from_user.id)
-    if not (db_user and (db_user.is_active or await db.is_user_admin(message.from_user.id))):
-        await message.answer("🚫 Доступ к функциям бота закрыт. Получите приглашение у администратора.")
+    if not await _check_access(message):
         return
     user_input = (message.text or "").strip()
     if not user_input:
@@ -64,9 +88,8 @@ async def qa_handler(message: Message) -> None:
                 await message.answer(answer)
             finally:
                 typing_task.cancel()
-                with suppress(Exception):
-                    await typing_task
-    except Exception as e:
+                await typing_task
+    except (TelegramAPIError, OpenAIError) as e:
         logger.error(f"QA error: {e}")
         await message.answer("Произошла ошибка при обращении к ИИ. Сообщите администратору.")
 
@@ -111,156 +134,27 @@ async def _answer_streaming(message: Message, question: str) -> None:
                 text_to_show = accumulated_text
                 if len(text_to_show) > 4096:
                     text_to_show = text_to_show[:4093] + "…"
-                with suppress(Exception):
+                with suppress(TelegramAPIError):
                     await reply.edit_text(text_to_show)
                 last_edit_ts = now
 
         final_text = accumulated_text.strip() or "К сожалению, не удалось получить ответ. Попробуйте переформулировать вопрос."
         if len(final_text) > 4096:
             final_text = final_text[:4093] + "…"
-        with suppress(Exception):
+        with suppress(TelegramAPIError):
             await reply.edit_text(final_text)
-    except Exception as e:
+    except (TelegramAPIError, OpenAIError) as e:
         logger.error(f"Streaming QA error: {e}")
-        with suppress(Exception):
+        with suppress(TelegramAPIError):
             await reply.edit_text("Произошла ошибка при обращении к ИИ. Сообщите администратору.")
 
 
-@router.message(F.voice)
-async def qa_voice_handler(message: Message) -> None:
-    # Проверка доступа
-    db_user = await db.get_user(message.from_user.id)
-    if not (db_user and (db_user.is_active or await db.is_user_admin(message.from_user.id))):
-        await message.answer("🚫 Доступ к функциям бота закрыт. Получите приглашение у администратора.")
-        return
-    """Принимаем голосовое сообщение: скачиваем, транскрибируем, отвечаем текстом."""
-    try:
-        voice = message.voice
-        if not voice:
-            return
-
-        # Поддерживаем индикацию «печатает…» пока идёт распознавание и подготовка ответа
-        sender_cm = ChatActionSender(bot=message.bot, chat_id=message.chat.id, action=ChatAction.TYPING)
-        await sender_cm.__aenter__()
-
-        # Скачиваем файл во временную директорию
-        file = await message.bot.get_file(voice.file_id)
-        src_path = f"/tmp/{voice.file_unique_id}.oga"
-        await message.bot.download_file(file.file_path, destination=src_path)
-
-        # Конвертация: OGG/Opus → WAV; поддерживаемые форматы отдаём как есть
-        wav_path = convert_to_wav(src_path)
-        if not wav_path:
-            logger.error("Конвертация голосового сообщения не удалась (возможно, нет opus-tools)")
-            await message.answer("Не удалось обработать аудио на сервере. Сообщите администратору (нужны opus-tools).")
-            return
-
-        # Транскрибуем аудио
-        transcript = await openai_service.transcribe_audio(wav_path)
-        if not transcript:
-            logger.warning("STT вернул пустой текст для voice")
-            await message.answer("Не удалось распознать голос. Попробуйте ещё раз.")
-            return
-
-        # Отвечаем как на обычный текст
-        if settings.openai_streaming_enabled:
-            await _answer_streaming(message, transcript)
-        else:
-            async with ChatActionSender(
-                bot=message.bot,
-                chat_id=message.chat.id,
-                action=ChatAction.TYPING,
-            ):
-                answer = await _answer(transcript, chat_id=message.chat.id)
-                if not answer:
-                    answer = "К сожалению, не удалось получить ответ. Попробуйте переформулировать вопрос."
-                await message.answer(answer)
-    except Exception as e:
-        logger.error(f"QA voice error: {e}")
-        await message.answer("Произошла ошибка при обработке голосового сообщения.")
-    finally:
-        # Завершаем индикацию и чистим временные файлы
-        with suppress(Exception):
-            if 'sender_cm' in locals():
-                await sender_cm.__aexit__(None, None, None)
-        with suppress(Exception):
-            if 'src_path' in locals() and os.path.exists(src_path):
-                os.remove(src_path)
-        with suppress(Exception):
-            if 'wav_path' in locals() and os.path.exists(wav_path) and wav_path != src_path:
-                os.remove(wav_path)
-
-
-@router.message(F.audio)
-async def qa_audio_handler(message: Message) -> None:
-    # Проверка доступа
-    db_user = await db.get_user(message.from_user.id)
-    if not (db_user and (db_user.is_active or await db.is_user_admin(message.from_user.id))):
-        await message.answer("🚫 Доступ к функциям бота закрыт. Получите приглашение у администратора.")
-        return
-    """Принимаем аудиофайл: скачиваем, транскрибируем, отвечаем текстом."""
-    try:
-        audio = message.audio
-        if not audio:
-            return
-
-        # Поддерживаем индикацию «печатает…» пока идёт распознавание и подготовка ответа
-        sender_cm = ChatActionSender(bot=message.bot, chat_id=message.chat.id, action=ChatAction.TYPING)
-        await sender_cm.__aenter__()
-
-        file = await message.bot.get_file(audio.file_id)
-        # Стараемся угадать расширение из пути на стороне Telegram
-        ext = os.path.splitext(file.file_path or "")[1] or ".bin"
-        src_path = f"/tmp/{audio.file_unique_id}{ext}"
-        await message.bot.download_file(file.file_path, destination=src_path)
-
-        wav_path = convert_to_wav(src_path)
-        if not wav_path:
-            logger.error("Конвертация аудиофайла не удалась (возможно, нет opus-tools)")
-            await message.answer("Не удалось обработать аудиофайл на сервере. Сообщите администратору (нужны opus-tools).")
-            return
-
-        transcript = await openai_service.transcribe_audio(wav_path)
-        if not transcript:
-            logger.warning("STT вернул пустой текст для audio")
-            await message.answer("Не удалось распознать аудио. Попробуйте другой файл.")
-            return
-
-        if settings.openai_streaming_enabled:
-            await _answer_streaming(message, transcript)
-        else:
-            async with ChatActionSender(
-                bot=message.bot,
-                chat_id=message.chat.id,
-                action=ChatAction.TYPING,
-            ):
-                answer = await _answer(transcript, chat_id=message.chat.id)
-                if not answer:
-                    answer = "К сожалению, не удалось получить ответ. Попробуйте переформулировать вопрос."
-                await message.answer(answer)
-    except Exception as e:
-        logger.error(f"QA audio error: {e}")
-        await message.answer("Произошла ошибка при обработке аудиофайла.")
-    finally:
-        with suppress(Exception):
-            if 'sender_cm' in locals():
-                await sender_cm.__aexit__(None, None, None)
-        with suppress(Exception):
-            if 'src_path' in locals() and os.path.exists(src_path):
-                os.remove(src_path)
-        with suppress(Exception):
-            if 'wav_path' in locals() and os.path.exists(wav_path) and wav_path != src_path:
-                os.remove(wav_path)
-
-
 @router.message(F.photo)
 async def qa_photo_handler(message: Message) -> None:
-    # Проверка доступа
-    db_user = await db.get_user(message.from_user.id)
-    if not (db_user and (db_user.is_active or await db.is_user_admin(message.from_user.id))):
-        await message.answer("🚫 Доступ к функциям бота закрыт. Получите приглашение у администратора.")
-        return
     """Принимаем фото/изображение: скачиваем, отправляем в vision, отвечаем текстом."""
+    if not await _check_access(message):
+        return
+    sender_cm = src_path = None
     try:
         photos = message.photo or []
         if not photos:
@@ -287,90 +181,136 @@ async def qa_photo_handler(message: Message) -> None:
         if not answer:
             answer = "К сожалению, не удалось проанализировать изображение. Попробуйте другое или добавьте пояснение."
         await message.answer(answer)
-    except Exception as e:
+    except (TelegramAPIError, OpenAIError, OSError) as e:
         logger.error(f"QA photo error: {e}")
         await message.answer("Произошла ошибка при обработке изображения.")
     finally:
-        with suppress(Exception):
-            if 'sender_cm' in locals():
-                await sender_cm.__aexit__(None, None, None)
-        with suppress(Exception):
-            if 'src_path' in locals() and os.path.exists(src_path):
-                os.remove(src_path)
+        if sender_cm is not None:
+            await sender_cm.__aexit__(None, None, None)
+        if src_path:
+            Path(src_path).unlink(missing_ok=True)
+
+
+async def _process_audio(message: Message, kind: str, src_path: str, temp_paths: List[str]) -> None:
+    """Голос/аудиофайл: конвертируем при необходимости, транскрибируем и отвечаем как на текст."""
+    is_voice = kind == "voice"
+    # Конвертация: OGG/Opus → WAV; поддерживаемые форматы отдаём как есть.
+    # Декодирование — CPU-работа, выполняем в пуле потоков, чтобы не блокировать event loop
+    wav_path = await asyncio.get_running_loop().run_in_executor(None, convert_to_wav, src_path)
+    if not wav_path:
+        logger.error(f"Конвертация {'голосового сообщения' if is_voice else 'аудиофайла'} не удалась")
+        await message.answer(
+            f"Не удалось обработать {'аудио' if is_voice else 'аудиофайл'} на сервере. "
+            "Сообщите администратору."
+        )
+        return
+    if wav_path != src_path:
+        temp_paths.append(wav_path)
+
+    transcript = await openai_service.transcribe_audio(wav_path)
+    if not transcript:
+        logger.warning(f"STT вернул пустой текст для {kind}")
+        await message.answer(
+            "Не удалось распознать голос. Попробуйте ещё раз."
+            if is_voice else "Не удалось распознать аудио. Попробуйте другой файл."
+        )
+        return
+
+    # Отвечаем как на обычный текст
+    if settings.openai_streaming_enabled:
+        await _answer_streaming(message, transcript)
+    else:
+        answer = await _answer(transcript, chat_id=message.chat.id)
+        if not answer:
+            answer = "К сожалению, не удалось получить ответ. Попробуйте переформулировать вопрос."
+        await message.answer(answer)
 
 
-@router.message(F.document)
-async def qa_document_handler(message: Message) -> None:
-    # Проверка доступа
-    db_user = await db.get_user(message.from_user.id)
-    if not (db_user and (db_user.is_active or await db.is_user_admin(message.from_user.id))):
-        await message.answer("🚫 Доступ к функциям бота закрыт. Получите приглашение у администратора.")
-        return
-    """Принимаем документ. Если PDF: добавляем во vector store и отвечаем на подпись. Если это изображение по MIME — обрабатываем как vision.
+async def _process_document(message: Message, kind: str, src_path: str, temp_paths: List[str]) -> None:
+    """Документ. Если PDF: добавляем во vector store и отвечаем на подпись. Если это изображение по MIME — обрабатываем как vision.
 
-    Иначе — просто добавляем файл в files (assistants) и просим модель ответить по подписи без file_search.
+    Иначе — просто подтверждаем получение и просим задать вопрос текстом.
     """
-    try:
-        doc = message.document
-        if not doc:
-            return
+    doc = message.document
+    caption = (message.caption or "").strip()
+    mime_type = (doc.mime_type or "").lower()
+
+    # Если это PDF — загрузим в vector store и ответим на подпись с использованием file_search
+    if src_path.lower().endswith(".pdf") or "pdf" in mime_type:
+        try:
+            fid = await openai_service.upload_pdf(src_path)
+            if not fid:
+                await message.answer("PDF получен, но не удалось добавить в базу знаний. Администратору стоит проверить логи.")
+            # После загрузки — короткий ответ на подпись (если есть). Далее текстовые вопросы будут работать с file_search автоматически.
+            if caption:
+                answer = await openai_service.answer_question(caption, chat_id=message.chat.id, use_file_search=True)
+                if not answer:
+                    answer = "Файл добавлен. Задайте вопрос по содержимому PDF."
+                await message.answer(answer)
+            else:
+                await message.answer("PDF добавлен в базу знаний. Теперь вы можете задавать вопросы по его содержанию.")
+        except (RuntimeError, TelegramAPIError, OpenAIError) as e:
+            logger.error(f"QA document (pdf) error: {e}")
+            await message.answer("Не удалось обработать PDF-файл.")
+        return
 
-        sender_cm = ChatActionSender(bot=message.bot, chat_id=message.chat.id, action=ChatAction.TYPING)
-        await sender_cm.__aenter__()
+    # Если это изображение, присланное как документ (например, PNG/JPEG/WEBP)
+    if any(mt in mime_type for mt in ["image/", "jpeg", "png", "webp", "gif"]):
+        q = caption or "Что изображено на этом файле?"
+        answer = await openai_service.analyze_image(src_path, question=q, detail="auto", chat_id=message.chat.id)
+        if not answer:
+            answer = "Не удалось проанализировать изображение. Попробуйте другое или добавьте пояснение."
+        await message.answer(answer)
+        return
 
-        file = await message.bot.get_file(doc.file_id)
-        # Определяем расширение
-        guessed_ext = os.path.splitext(doc.file_name or "")[1] or os.path.splitext(file.file_path or "")[1] or ""
-        if not guessed_ext:
-            # попробуем по MIME
-            mime = doc.mime_type or ""
-            guessed_ext = mimetypes.guess_extension(mime) or ""
-        ext = guessed_ext or ".bin"
-        src_path = f"/tmp/{doc.file_unique_id}{ext}"
-        await message.bot.download_file(file.file_path, destination=src_path)
+    # Прочие документы: просто подтверждаем загрузку и советуем задавать вопросы текстом
+    await message.answer("Файл получен. Для PDF мы можем добавить в базу знаний, для других форматов задайте текстовый вопрос, приложив нужные фрагменты.")
 
-        caption = (message.caption or "").strip()
-        mime_type = (doc.mime_type or "").lower()
 
-        # Если это PDF — загрузим в vector store и ответим на подпись с использованием file_search
-        if ext.lower() == ".pdf" or "pdf" in mime_type:
-            try:
-                fid = openai_service.upload_pdf(src_path)
-                if not fid:
-                    await message.answer("PDF получен, но не удалось добавить в базу знаний. Администратору стоит проверить логи.")
-                # После загрузки — короткий ответ на подпись (если есть). Далее текстовые вопросы будут работать с file_search автоматически.
-                if caption:
-                    answer = await openai_service.answer_question(caption, chat_id=message.chat.id, use_file_search=True)
-                    if not answer:
-                        answer = "Файл добавлен. Задайте вопрос по содержимому PDF."
-                    await message.answer(answer)
-                else:
-                    await message.answer("PDF добавлен в базу знаний. Теперь вы можете задавать вопросы по его содержанию.")
-            except Exception as e:
-                logger.error(f"QA document (pdf) error: {e}")
-                await message.answer("Не удалось обработать PDF-файл.")
-            return
+def _guess_ext(message: Message, kind: str, file_path: str) -> str:
+    """Расширение временного файла: по имени документа, пути на стороне Telegram или MIME."""
+    ext = os.path.splitext(message.document.file_name or "")[1] if kind == "document" else ""
+    ext = ext or os.path.splitext(file_path or "")[1]
+    if not ext and kind == "document":
+        ext = _EXT_BY_MIME.get(message.document.mime_type or "", "")
+    return ext or ".bin"
+
+
+# Тип медиа -> (фиксированное расширение или None, обработчик, текст ошибки)
+_MEDIA_CONFIG: Dict[str, Tuple[Optional[str], MediaProcessor, str]] = {
+    "voice": (".oga", _process_audio, "Произошла ошибка при обработке голосового сообщения."),
+    "audio": (None, _process_audio, "Произошла ошибка при обработке аудиофайла."),
+    "document": (None, _process_document, "Произошла ошибка при обработке документа."),
+}
 
-        # Если это изображение, присланное как документ (например, PNG/JPEG/WEBP)
-        if any(mt in mime_type for mt in ["image/", "jpeg", "png", "webp", "gif"]):
-            q = caption or "Что изображено на этом файле?"
-            answer = await openai_service.analyze_image(src_path, question=q, detail="auto", chat_id=message.chat.id)
-            if not answer:
-                answer = "Не удалось проанализировать изображение. Попробуйте другое или добавьте пояснение."
-            await message.answer(answer)
-            return
 
-        # Прочие документы: просто подтверждаем загрузку и советуем задавать вопросы текстом
-        await message.answer("Файл получен. Для PDF мы можем добавить в базу знаний, для других форматов задайте текстовый вопрос, приложив нужные фрагменты.")
-    except Exception as e:
-        logger.error(f"QA document error: {e}")
-        await message.answer("Произошла ошибка при обработке документа.")
+async def _process_media(message: Message, kind: str) -> None:
+    """Общий конвейер для медиа: «печатает…» → скачивание → обработка → очистка временных файлов."""
+    fixed_ext, processor, error_text = _MEDIA_CONFIG[kind]
+    media = getattr(message, kind)
+    temp_paths: List[str] = []
+    try:
+        # Поддерживаем индикацию «печатает…» всё время обработки
+        async with ChatActionSender(bot=message.bot, chat_id=message.chat.id, action=ChatAction.TYPING):
+            # Скачиваем файл во временную директорию
+            file = await message.bot.get_file(media.file_id)
+            src_path = f"/tmp/{media.file_unique_id}{fixed_ext or _guess_ext(message, kind, file.file_path)}"
+            temp_paths.append(src_path)
+            await message.bot.download_file(file.file_path, destination=src_path)
+
+            await processor(message, kind, src_path, temp_paths)
+    except (TelegramAPIError, OpenAIError, OSError) as e:
+        logger.error(f"QA {kind} error: {e}")
+        await message.answer(error_text)
     finally:
-        with suppress(Exception):
-            if 'sender_cm' in locals():
-                await sender_cm.__aexit__(None, None, None)
-        with suppress(Exception):
-            if 'src_path' in locals() and os.path.exists(src_path):
-                os.remove(src_path)
+        for path in temp_paths:
+            Path(path).unlink(missing_ok=True)
 
 
+@router.message(F.voice | F.audio | F.document)
+async def qa_media_handler(message: Message) -> None:
+    """Принимаем голосовое, аудиофайл или документ и обрабатываем общим конвейером."""
+    if not await _check_access(message):
+        return
+    kind = "voice" if message.voice else "audio" if message.audio else "document"
+    await _process_media(message, kind)
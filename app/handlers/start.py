@@ -17,22 +17,6 @@ async def start_command(message: Message):
     """Обработчик команды /start"""
     user = message.from_user
     
-    # Сохраняем пользователя в базу данных
-    await db.add_user(
-        user_id=user.id,
-        username=user.username,
-        first_name=user.first_name,
-        last_name=user.last_name
-    )
-    
-    # Авто-выдаем админку и доступ, если пользователь в ENV-админах
-    if settings.is_admin(user.id):
-        try:
-            await db.set_user_admin(user.id, True)
-            await db.set_user_access(user.id, True)
-        except Exception as e:
-            logger.warning(f"Не удалось обновить права ENV-админу {user.id}: {e}")
-    
     # Проверяем, есть ли deep-link токен: "/start <token>"
     token: str | None = None
     text = message.text or ""
@@ -40,12 +24,25 @@ async def start_command(message: Message):
     if len(parts) == 2:
         token = parts[1].strip()
     
-    # Если есть токен — пытаемся активировать приглашение
+    # Если есть токен — пытаемся активировать приглашение (до сохранения пользователя,
+    # чтобы выдать доступ тем же запросом)
+    used = False
     if token:
         used = await db.use_invitation(token, user.id)
+    
+    # Сохраняем пользователя одним UPSERT; ENV-админам сразу выдаём админку и доступ
+    is_active, is_admin = await db.upsert_and_fetch_user(
+        user_id=user.id,
+        username=user.username,
+        first_name=user.first_name,
+        last_name=user.last_name,
+        force_admin=settings.is_admin(user.id),
+        force_active=used,
+    )
+    
+    if token:
         if used:
-            # Выдаем доступ
-            await db.set_user_access(user.id, True)
+            logger.info(f"Пользователь {user.id} активировал доступ по приглашению")
             welcome_text = (
                 f"👋 Привет, {user.first_name or 'пользователь'}!\n\n"
                 f"✅ Ваш доступ активирован по приглашению.\n\n"
@@ -54,15 +51,14 @@ async def start_command(message: Message):
             await message.answer(welcome_text)
             return
         else:
+            logger.info(f"Пользователь {user.id} перешёл по недействительному приглашению")
             await message.answer(
                 "❌ Ссылка-приглашение недействительна или уже использована. Обратитесь к администратору."
             )
             return
     
     # Если пользователь уже имеет доступ — показываем приветствие
-    db_user = await db.get_user(user.id)
-    is_admin = await db.is_user_admin(user.id)
-    if db_user and (db_user.is_active or is_admin):
+    if is_active or is_admin:
         # Приветственное сообщение
         welcome_text = f"""
 👋 Привет, {user.first_name or 'пользователь'}!
@@ -1,6 +1,6 @@
 """
 Keyboards package
 """
-from .admin import AdminKeyboards
+from .admin import AdminKeyboards, AdminUserCB
 
-__all__ = ["AdminKeyboards"] 
\ No newline at end of file
+__all__ = ["AdminKeyboards", "AdminUserCB"] 
\ No newline at end of file
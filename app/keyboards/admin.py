@@ -1,100 +1,94 @@
 """
 Клавиатуры для админской части
 """
+from functools import lru_cache
+
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 
+class AdminUserCB(CallbackData, prefix="au"):
+    """callback_data для списка и карточки пользователя: au:<action>:<user_id>
+
+    action: open | grant | revoke | make_admin
+    """
+    action: str
+    user_id: int
+
+
+def _user_button(text: str, action: str, user_id: int) -> InlineKeyboardButton:
+    # Данные формируем сами — пропускаем валидацию pydantic на каждую кнопку
+    return InlineKeyboardButton.model_construct(
+        text=text,
+        callback_data=AdminUserCB(action=action, user_id=user_id).pack()
+    )
+
+
+def _build_menu(*buttons: InlineKeyboardButton) -> InlineKeyboardMarkup:
+    """Собрать клавиатуру из кнопок в один столбец"""
+    builder = InlineKeyboardBuilder()
+    builder.add(*buttons)
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+# Неизменяемые клавиатуры и кнопки собираем один раз при импорте
+_CANCEL_BROADCAST_BUTTON = InlineKeyboardButton(text="❌ Отменить", callback_data="broadcast_cancel")
+_BACK_TO_MAIN_BUTTON = InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_back_main")
+_BACK_TO_USERS_BUTTON = InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_users")
+
+_MAIN_ADMIN_MENU = _build_menu(
+    InlineKeyboardButton(text="📊 Рассылка", callback_data="admin_broadcast"),
+    InlineKeyboardButton(text="🔗 Сгенерировать приглашение", callback_data="admin_invite"),
+    InlineKeyboardButton(text="👥 Пользователи", callback_data="admin_users"),
+    InlineKeyboardButton(text="📚 Хранилище документов (/docs_store)", callback_data="noop_docs_store"),
+    InlineKeyboardButton(text="⬆️ Загрузить PDF (/docs_upload)", callback_data="noop_docs_upload"),
+)
+
+_BROADCAST_ADD_BUTTON = _build_menu(
+    InlineKeyboardButton(text="➕ Добавить кнопку", callback_data="broadcast_add_button"),
+    InlineKeyboardButton(text="📤 Отправить без кнопки", callback_data="broadcast_no_button"),
+    _CANCEL_BROADCAST_BUTTON,
+)
+
+_BROADCAST_BUTTON_CONFIRM = _build_menu(
+    InlineKeyboardButton(text="✅ Подтвердить", callback_data="broadcast_button_confirm"),
+    _CANCEL_BROADCAST_BUTTON,
+)
+
+_BROADCAST_CONFIRM_NO_BUTTON = InlineKeyboardButton(text="❌ Отменить", callback_data="broadcast_confirm_no")
+
+
 class AdminKeyboards:
     """Клавиатуры для админской панели"""
     
     @staticmethod
     def main_admin_menu() -> InlineKeyboardMarkup:
         """Главное меню админа"""
-        builder = InlineKeyboardBuilder()
-        
-        builder.add(InlineKeyboardButton(
-            text="📊 Рассылка",
-            callback_data="admin_broadcast"
-        ))
-        builder.add(InlineKeyboardButton(
-            text="🔗 Сгенерировать приглашение",
-            callback_data="admin_invite"
-        ))
-        builder.add(InlineKeyboardButton(
-            text="👥 Пользователи",
-            callback_data="admin_users"
-        ))
-        builder.add(InlineKeyboardButton(
-            text="📚 Хранилище документов (/docs_store)",
-            callback_data="noop_docs_store"
-        ))
-        builder.add(InlineKeyboardButton(
-            text="⬆️ Загрузить PDF (/docs_upload)",
-            callback_data="noop_docs_upload"
-        ))
-        
-        builder.adjust(1)
-        return builder.as_markup()
+        return _MAIN_ADMIN_MENU
     
     @staticmethod
+    @lru_cache(maxsize=512)
     def broadcast_confirm(message_count: int) -> InlineKeyboardMarkup:
         """Подтверждение рассылки"""
-        builder = InlineKeyboardBuilder()
-        
-        builder.add(InlineKeyboardButton(
-            text=f"✅ Отправить ({message_count} польз.)",
-            callback_data="broadcast_confirm_yes"
-        ))
-        
-        builder.add(InlineKeyboardButton(
-            text="❌ Отменить",
-            callback_data="broadcast_confirm_no"
-        ))
-        
-        builder.adjust(1)
-        return builder.as_markup()
+        return _build_menu(
+            InlineKeyboardButton(
+                text=f"✅ Отправить ({message_count} польз.)",
+                callback_data="broadcast_confirm_yes"
+            ),
+            _BROADCAST_CONFIRM_NO_BUTTON,
+        )
     
     @staticmethod
     def broadcast_add_button() -> InlineKeyboardMarkup:
         """Меню добавления кнопки к рассылке"""
-        builder = InlineKeyboardBuilder()
-        
-        builder.add(InlineKeyboardButton(
-            text="➕ Добавить кнопку",
-            callback_data="broadcast_add_button"
-        ))
-        
-        builder.add(InlineKeyboardButton(
-            text="📤 Отправить без кнопки",
-            callback_data="broadcast_no_button"
-        ))
-        
-        builder.add(InlineKeyboardButton(
-            text="❌ Отменить",
-            callback_data="broadcast_cancel"
-        ))
-        
-        builder.adjust(1)
-        return builder.as_markup()
+        return _BROADCAST_ADD_BUTTON
     
     @staticmethod
     def broadcast_button_confirm() -> InlineKeyboardMarkup:
         """Подтверждение кнопки для рассылки"""
-        builder = InlineKeyboardBuilder()
-        
-        builder.add(InlineKeyboardButton(
-            text="✅ Подтвердить",
-            callback_data="broadcast_button_confirm"
-        ))
-        
-        builder.add(InlineKeyboardButton(
-            text="❌ Отменить",
-            callback_data="broadcast_cancel"
-        ))
-        
-        builder.adjust(1)
-        return builder.as_markup()
+        return _BROADCAST_BUTTON_CONFIRM
     
     @staticmethod
     def create_custom_button(text: str, url: str) -> InlineKeyboardMarkup:
@@ -112,12 +106,8 @@ class AdminKeyboards:
     def users_list(users: list[tuple[int, str]]) -> InlineKeyboardMarkup:
         """Список пользователей (кнопки)"""
         builder = InlineKeyboardBuilder()
-        for user_id, title in users:
-            builder.add(InlineKeyboardButton(
-                text=title,
-                callback_data=f"admin_user_{user_id}"
-            ))
-        builder.add(InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_back_main"))
+        builder.add(*(_user_button(title, "open", user_id) for user_id, title in users))
+        builder.add(_BACK_TO_MAIN_BUTTON)
         builder.adjust(1)
         return builder.as_markup()
 
@@ -126,11 +116,11 @@ class AdminKeyboards:
         """Кнопки действий в карточке пользователя"""
         builder = InlineKeyboardBuilder()
         if is_active:
-            builder.add(InlineKeyboardButton(text="🚫 Забрать доступ", callback_data=f"admin_user_revoke_{user_id}"))
+            builder.add(_user_button("🚫 Забрать доступ", "revoke", user_id))
         else:
-            builder.add(InlineKeyboardButton(text="✅ Выдать доступ", callback_data=f"admin_user_grant_{user_id}"))
+            builder.add(_user_button("✅ Выдать доступ", "grant", user_id))
         if not is_admin:
-            builder.add(InlineKeyboardButton(text="⭐ Сделать админом", callback_data=f"admin_user_make_admin_{user_id}"))
-        builder.add(InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_users"))
+            builder.add(_user_button("⭐ Сделать админом", "make_admin", user_id))
+        builder.add(_BACK_TO_USERS_BUTTON)
         builder.adjust(1)
         return builder.as_markup()
\ No newline at end of file
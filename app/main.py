@@ -2,11 +2,18 @@
 Главный файл бота
 """
 import asyncio
+import ssl
 import sys
+from typing import Optional
+
+import certifi
+import uvloop
+from aiohttp import ClientSession, TCPConnector
 from loguru import logger
 
-from aiogram import Bot, Dispatcher
+from aiogram import Bot, Dispatcher, __version__ as aiogram_version
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
 from aiogram.fsm.storage.redis import RedisStorage
 
@@ -14,6 +21,57 @@ from app.config import settings
 from app.handlers import setup_routers
 from app.middlewares import setup_middlewares
 from app.database import db
+from app.services.redis_client import get_redis, redis_pool
+from app.services.user_batch_writer import user_batch_writer
+from app.services.openai_service import openai_service
+
+# Таймаут long polling (сек): максимальный практичный, меньше пробуждений цикла
+POLLING_TIMEOUT = 25
+# Размер пула соединений к Bot API (рассылка держит до 50 запросов одновременно)
+BOT_API_POOL_LIMIT = 200
+
+
+class PooledAiohttpSession(AiohttpSession):
+    """AiohttpSession с настраиваемым пулом соединений к Bot API
+
+    Параметры TCPConnector задаются через конструктор; ClientSession создаётся
+    в публичном create_session (его вызывает make_request) и закрывается в close,
+    без обращения к внутренним полям AiohttpSession.
+    """
+
+    def __init__(self, *, limit: int, limit_per_host: int, keepalive_timeout: float, **kwargs) -> None:
+        super().__init__(limit=limit, **kwargs)
+        self._connector_options = {
+            "limit": limit,
+            "limit_per_host": limit_per_host,
+            "keepalive_timeout": keepalive_timeout,
+            "ttl_dns_cache": 3600,
+            "enable_cleanup_closed": True,
+            "ssl": ssl.create_default_context(cafile=certifi.where()),
+        }
+        self._client_session: Optional[ClientSession] = None
+
+    async def create_session(self) -> ClientSession:
+        if self._client_session is None or self._client_session.closed:
+            self._client_session = ClientSession(
+                connector=TCPConnector(**self._connector_options),
+                headers={"User-Agent": f"aiogram/{aiogram_version}"},
+            )
+        return self._client_session
+
+    async def close(self) -> None:
+        if self._client_session is not None and not self._client_session.closed:
+            await self._client_session.close()
+        await super().close()
+
+
+def _build_session() -> AiohttpSession:
+    """HTTP-сессия Bot API с увеличенным пулом и долгим keep-alive"""
+    return PooledAiohttpSession(
+        limit=BOT_API_POOL_LIMIT,
+        limit_per_host=BOT_API_POOL_LIMIT // 2,
+        keepalive_timeout=75,
+    )
 
 
 async def setup_bot() -> tuple[Bot, Dispatcher]:
@@ -22,12 +80,13 @@ async def setup_bot() -> tuple[Bot, Dispatcher]:
     # Создаем бота
     bot = Bot(
         token=settings.bot_token,
+        session=_build_session(),
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
     
     # Создаем хранилище состояний
     try:
-        storage = RedisStorage.from_url(settings.redis_url)
+        storage = RedisStorage(redis=get_redis())
         logger.info("✅ Redis storage connected successfully")
     except Exception as e:
         logger.error(f"❌ Failed to connect to Redis: {e}")
@@ -52,6 +111,10 @@ async def on_startup(bot: Bot) -> None:
         await db.create_tables()
         await db.update_bot_stats()
         logger.info("✅ Database initialized successfully")
+        # Пакетная запись пользователей из UserMiddleware
+        user_batch_writer.start()
+        # Фоновые очереди OpenAI (Batch API для суммаризации, если включён)
+        openai_service.start()
     except Exception as e:
         logger.error(f"❌ Failed to initialize database: {e}")
         sys.exit(1)
@@ -64,7 +127,15 @@ async def on_startup(bot: Bot) -> None:
 async def on_shutdown(bot: Bot) -> None:
     """Действия при остановке бота"""
     logger.info("🛑 Bot is shutting down...")
+    # Дописываем пользователей, оставшихся в очереди
+    await user_batch_writer.stop()
+    # Дожидаемся фоновых записей истории диалогов, пока Redis ещё доступен, и закрываем HTTP-пул OpenAI
+    await openai_service.shutdown()
     await bot.session.close()
+    # Закрываем общий пул соединений Redis
+    await redis_pool.disconnect()
+    # Дожидаемся записи сообщений, стоящих в очереди loguru
+    await logger.complete()
 
 
 async def main() -> None:
@@ -72,15 +143,26 @@ async def main() -> None:
     
     # Настройка логирования
     logger.remove()
+    # enqueue=True: запись идёт из отдельного потока, хендлеры не ждут форматирования и I/O
     logger.add(
         sys.stdout,
-        level=settings.log_level,
+        level="WARNING" if settings.log_file else settings.log_level,
         format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | "
                "<level>{level: <8}</level> | "
                "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - "
                "<level>{message}</level>",
-        colorize=True
+        colorize=True,
+        enqueue=True
     )
+    if settings.log_file:
+        logger.add(
+            settings.log_file,
+            level=settings.log_level,
+            serialize=True,
+            enqueue=True,
+            rotation="50 MB",
+            retention=5
+        )
     
     logger.info("🎯 Starting Aiogram Bot...")
     
@@ -91,11 +173,15 @@ async def main() -> None:
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
     
+    # Типы апдейтов вычисляем один раз после регистрации роутеров
+    used_updates = dp.resolve_used_update_types()
+    
     try:
         # Запускаем polling
         await dp.start_polling(
             bot,
-            allowed_updates=dp.resolve_used_update_types()
+            allowed_updates=used_updates,
+            polling_timeout=POLLING_TIMEOUT
         )
     except KeyboardInterrupt:
         logger.info("👋 Bot stopped by user")
@@ -106,6 +192,8 @@ async def main() -> None:
 
 
 if __name__ == "__main__":
+    # uvloop: более быстрый event loop для I/O-нагруженного бота
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
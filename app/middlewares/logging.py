@@ -1,11 +1,14 @@
 """
 Middleware для логирования запросов
 """
+import random
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, Message, CallbackQuery
 from loguru import logger
 
+from app.config import settings
+
 
 class LoggingMiddleware(BaseMiddleware):
     """Middleware для логирования всех входящих обновлений"""
@@ -18,26 +21,29 @@ class LoggingMiddleware(BaseMiddleware):
     ) -> Any:
         """Основной метод middleware"""
         
-        # Логируем входящие сообщения
+        # Под нагрузкой логируем только выборку апдейтов (LOG_SAMPLE_RATE)
+        if random.random() >= settings.log_sample_rate:
+            return await handler(event, data)
+        
+        # Сообщение форматируется только если INFO реально пишется хоть одним sink-ом
         if isinstance(event, Message):
             user = event.from_user
-            logger.info(
-                f"📥 Message from {user.id} (@{user.username}): "
-                f"'{event.text[:50] if event.text else 'No text'}'"
+            logger.opt(lazy=True).info(
+                "📥 Message from {} (@{}): '{}'",
+                lambda: user.id,
+                lambda: user.username,
+                lambda: event.text[:50] if event.text else "No text",
             )
         
         # Логируем callback запросы
         elif isinstance(event, CallbackQuery):
             user = event.from_user
-            logger.info(
-                f"🔘 Callback from {user.id} (@{user.username}): "
-                f"'{event.data}'"
+            logger.opt(lazy=True).info(
+                "🔘 Callback from {} (@{}): '{}'",
+                lambda: user.id,
+                lambda: user.username,
+                lambda: event.data,
             )
         
-        # Выполняем обработчик
-        try:
-            result = await handler(event, data)
-            return result
-        except Exception as e:
-            logger.error(f"❌ Error in handler: {e}")
-            raise
+        # Ошибки обработчиков логирует диспетчер aiogram
+        return await handler(event, data)
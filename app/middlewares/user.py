@@ -1,17 +1,37 @@
 """
 Middleware для работы с пользователями
 """
+import hashlib
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, User
 from loguru import logger
 
-from app.database import db
+from app.services.redis_client import get_redis
+from app.services.user_batch_writer import user_batch_writer
 
 
 class UserMiddleware(BaseMiddleware):
-    """Middleware для автоматического сохранения пользователей"""
-    
+    """Middleware для автоматического сохранения пользователей
+
+    В БД пишем только при первом обращении за SEEN_TTL секунд или при смене
+    username/имени: отметка «seen» ставится в Redis через SET NX. Сама запись
+    идёт через очередь пакетного writer-а и не задерживает обработку апдейта;
+    если запись не удалась, writer снимает отметку, и следующий апдейт её повторит.
+    """
+
+    SEEN_TTL = 300
+
+    def __init__(self) -> None:
+        self.redis = get_redis()
+
+    @staticmethod
+    def _seen_key(user: User) -> str:
+        # Хэш профиля в ключе: при смене username/имени получим промах и обновим запись
+        profile = f"{user.username}|{user.first_name}|{user.last_name}".encode("utf-8")
+        digest = hashlib.blake2b(profile, digest_size=8).hexdigest()
+        return f"seen:{user.id}:{digest}"
+
     async def __call__(
         self,
         handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
@@ -20,18 +40,17 @@ class UserMiddleware(BaseMiddleware):
     ) -> Any:
         # Получаем пользователя из события
         user: User = data.get("event_from_user")
-        
+
         if user and not user.is_bot:
+            seen_key = self._seen_key(user)
             try:
-                # Сохраняем/обновляем пользователя в базе данных
-                await db.add_user(
-                    user_id=user.id,
-                    username=user.username,
-                    first_name=user.first_name,
-                    last_name=user.last_name
-                )
+                is_new = await self.redis.set(seen_key, "1", ex=self.SEEN_TTL, nx=True)
             except Exception as e:
-                logger.error(f"Ошибка при сохранении пользователя {user.id}: {e}")
-        
+                # Redis недоступен — лучше лишний раз записать в БД, чем потерять пользователя
+                logger.warning(f"Redis seen-check error for {user.id}: {e}")
+                is_new = True
+            if is_new:
+                user_batch_writer.enqueue(user, seen_key)
+
         # Продолжаем обработку
-        return await handler(event, data) 
\ No newline at end of file
+        return await handler(event, data)
@@ -1,55 +1,73 @@
 """
 Утилиты для работы с аудио.
 
-- Для Telegram voice (OGG/Opus) используем opusdec (из пакета opus-tools),
-  чтобы конвертировать в WAV (PCM16, mono). Это минимум зависимостей.
+- Для Telegram voice (OGG/Opus) декодируем звук прямо в процессе через PyAV (libav),
+  без запуска внешних утилит, и сохраняем в WAV (PCM16, mono).
 - Для аудио в форматах, которые поддерживает OpenAI (mp3/mp4/mpeg/mpga/m4a/wav/webm),
   конвертация не требуется — их отдаём напрямую в STT.
 """
 from __future__ import annotations
 
 import os
-import subprocess
 import uuid
-from typing import Optional
+import wave
+from typing import List, Optional
+
+import av
+from loguru import logger
+
+# Форматы, которые OpenAI STT принимает напрямую
+_SUPPORTED_DIRECT = frozenset({"mp3", "mp4", "mpeg", "mpga", "m4a", "wav", "webm"})
+# Голосовые Telegram (OGG/Opus)
+_OGG = frozenset({"oga", "ogg"})
+
+
+def _decode_to_pcm16(input_path: str, sample_rate: int) -> bytes:
+    """Декодировать первую аудиодорожку в PCM16 mono с заданной частотой."""
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=sample_rate)
+    chunks: List[bytes] = []
+    with av.open(input_path) as container:
+        for frame in container.decode(audio=0):
+            for out in resampler.resample(frame):
+                # Упакованный s16 mono: 2 байта на сэмпл, отрезаем выравнивание буфера
+                chunks.append(bytes(out.planes[0])[: out.samples * 2])
+        # Сбрасываем остаток из ресемплера
+        for out in resampler.resample(None):
+            chunks.append(bytes(out.planes[0])[: out.samples * 2])
+    return b"".join(chunks)
 
 
 def convert_to_wav(input_path: str, *, sample_rate: int = 16000) -> Optional[str]:
     """Конвертировать OGG/Opus в WAV (PCM16, mono). Для поддерживаемых OpenAI форматов — пропустить.
 
     Если расширение файла входит в список допустимых для OpenAI — возвращает исходный путь.
-    Если .oga/.ogg — конвертирует с помощью opusdec в WAV (16kHz, mono) и возвращает путь к .wav.
+    Если .oga/.ogg — декодирует через PyAV в WAV (16kHz, mono) и возвращает путь к .wav.
     Иначе — None.
     """
     if not os.path.exists(input_path):
         return None
 
-    _, ext = os.path.splitext(input_path.lower())
-    # Поддерживаемые OpenAI напрямую
-    supported_direct = {".mp3", ".mp4", ".mpeg", ".mpga", ".m4a", ".wav", ".webm"}
-    if ext in supported_direct:
+    # Расширение без точки; lower() только для него, а не для всего пути
+    ext = input_path.rpartition(".")[2].lower()
+    if ext in _SUPPORTED_DIRECT:
         return input_path
 
-    # Голосовые Telegram: .oga/.ogg → opusdec в WAV
-    if ext in {".oga", ".ogg"}:
+    # Голосовые Telegram: .oga/.ogg → PCM16 в памяти → WAV
+    if ext in _OGG:
         output_path = f"/tmp/{uuid.uuid4().hex}.wav"
-        # Конвертация потоком через ffmpeg нам не нужна — используем opusdec
-        # Принудительно зададим частоту дискретизации и моно через sox-пайп не будем; opusdec выдаёт PCM WAV
-        cmd = [
-            "opusdec",
-            "--rate",
-            str(sample_rate),
-            "--force-wav",
-            input_path,
-            output_path,
-        ]
         try:
-            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            pcm = _decode_to_pcm16(input_path, sample_rate)
+            with wave.open(output_path, "wb") as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(sample_rate)
+                wav.writeframes(pcm)
             return output_path
-        except Exception:
+        except Exception as e:
+            logger.error(f"Не удалось декодировать аудио '{input_path}': {e}")
+            if os.path.exists(output_path):
+                os.remove(output_path)
             return None
 
     # Неподдерживаемый формат
     return None
-
-
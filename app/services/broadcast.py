@@ -2,10 +2,12 @@
 Сервис рассылки сообщений
 """
 import asyncio
-from typing import List, Optional, Dict, Any
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
 from aiogram import Bot
 from aiogram.types import Message, InlineKeyboardMarkup
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiolimiter import AsyncLimiter
 from loguru import logger
 
 from app.database import db
@@ -14,8 +16,24 @@ from app.database import db
 class BroadcastService:
     """Сервис для рассылки сообщений"""
     
+    # Глобальный лимит Telegram ~30 сообщений/с — держим небольшой запас
+    RATE_LIMIT_PER_SEC = 28
+    # Максимум одновременно выполняющихся запросов
+    MAX_CONCURRENCY = 50
+    # Как часто (в отправленных сообщениях) сообщать о прогрессе
+    PROGRESS_EVERY = 100
+    
+    # Коды результата отправки — индексы в списке счётчиков
+    SENT = 1
+    BLOCKED = 2
+    FAILED = 3
+    
     def __init__(self, bot: Bot):
         self.bot = bot
+        self._limiter = AsyncLimiter(self.RATE_LIMIT_PER_SEC, 1.0)
+        # Установлен — отправка разрешена; сброшен — вся рассылка стоит на паузе после 429
+        self._pause_event = asyncio.Event()
+        self._pause_event.set()
     
     async def send_broadcast(
         self,
@@ -26,6 +44,9 @@ class BroadcastService:
         """
         Отправка рассылки всем пользователям
         
+        Сообщения отправляются непрерывным потоком через token bucket
+        (RATE_LIMIT_PER_SEC) с ограничением числа одновременных запросов.
+        
         Args:
             message: Сообщение для рассылки
             custom_keyboard: Кастомная клавиатура
@@ -34,160 +55,139 @@ class BroadcastService:
         Returns:
             Словарь со статистикой отправки
         """
-        users = await db.get_active_users()
+        # Оценку общего числа получателей берём дешёвым COUNT(*) параллельно с выборкой
+        count_task = asyncio.create_task(db.get_active_users_count())
         
         stats = {
-            "total": len(users),
+            "total": 0,
             "sent": 0,
             "failed": 0,
             "blocked": 0
         }
+        # counts[код результата] += 1 — без классификации исключений на каждого получателя
+        counts = [0, 0, 0, 0]
         
-        logger.info(f"Начинаем рассылку для {len(users)} пользователей")
+        def _sync_stats() -> None:
+            stats["sent"] = counts[self.SENT]
+            stats["blocked"] = counts[self.BLOCKED]
+            stats["failed"] = counts[self.FAILED]
         
-        # Отправляем сообщения пачками по 30 штук
-        batch_size = 30
-        delay_between_batches = 1  # секунда между пачками
+        logger.info("Начинаем рассылку активным пользователям")
         
-        for i in range(0, len(users), batch_size):
-            batch = users[i:i + batch_size]
-            tasks = []
-            
-            for user in batch:
-                task = self._send_single_message(
-                    user_id=user.id,
-                    message=message,
-                    custom_keyboard=custom_keyboard
-                )
-                tasks.append(task)
-            
-            # Выполняем пачку параллельно
-            results = await asyncio.gather(*tasks, return_exceptions=True)
+        # copyMessage копирует любой тип сообщения на стороне Telegram (медиа, подпись, entities)
+        send = partial(self.bot.copy_message, from_chat_id=message.chat.id, message_id=message.message_id)
+        
+        semaphore = asyncio.Semaphore(self.MAX_CONCURRENCY)
+        pending: Set[asyncio.Task] = set()
+        
+        def _on_done(task: asyncio.Task) -> None:
+            pending.discard(task)
+            semaphore.release()
+            if task.cancelled() or task.exception() is not None:
+                counts[self.FAILED] += 1
+            else:
+                counts[task.result()] += 1
+        
+        reported = 0
+        queued = 0
+        async for user in db.stream_active_users():
+            if not stats["total"] and count_task.done() and not count_task.exception():
+                stats["total"] = count_task.result()
             
-            # Обрабатываем результаты
-            for result in results:
-                if isinstance(result, Exception):
-                    if isinstance(result, TelegramForbiddenError):
-                        stats["blocked"] += 1
-                    else:
-                        stats["failed"] += 1
-                elif result:
-                    stats["sent"] += 1
-                else:
-                    stats["failed"] += 1
+            # Не создаём больше задач, чем допускает семафор
+            await semaphore.acquire()
+            task = asyncio.create_task(self._send_with_limits(
+                user_id=user.id,
+                send=send,
+                custom_keyboard=custom_keyboard
+            ))
+            pending.add(task)
+            task.add_done_callback(_on_done)
+            queued += 1
             
             # Вызываем callback для обновления прогресса
-            if progress_callback:
+            processed = counts[self.SENT] + counts[self.BLOCKED] + counts[self.FAILED]
+            if progress_callback and stats["total"] and processed - reported >= self.PROGRESS_EVERY:
+                reported = processed
+                _sync_stats()
                 await progress_callback(stats)
-            
-            # Пауза между пачками
-            if i + batch_size < len(users):
-                await asyncio.sleep(delay_between_batches)
+        
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        # Итог — фактическое число получателей, а не оценка
+        await asyncio.gather(count_task, return_exceptions=True)
+        stats["total"] = queued
+        _sync_stats()
+        if progress_callback and queued:
+            await progress_callback(stats)
         
         logger.info(f"Рассылка завершена. Отправлено: {stats['sent']}, Ошибок: {stats['failed']}, Заблокировано: {stats['blocked']}")
         return stats
     
+    async def _send_with_limits(
+        self,
+        user_id: int,
+        send: Callable[..., Awaitable[Any]],
+        custom_keyboard: Optional[InlineKeyboardMarkup] = None
+    ) -> int:
+        """Отправка одного сообщения с учётом rate limit; при 429 ставим паузу на всю рассылку и повторяем один раз"""
+        for _ in range(2):
+            # Во время глобальной паузы (flood control) все отправки ждут здесь
+            await self._pause_event.wait()
+            async with self._limiter:
+                try:
+                    return await self._send_single_message(user_id, send, custom_keyboard)
+                except TelegramRetryAfter as e:
+                    retry_after = e.retry_after
+            await self._pause(retry_after)
+        return self.FAILED
+    
+    async def _pause(self, retry_after: int) -> None:
+        """Остановить все отправки на retry_after секунд (одна пауза на всех получивших 429)"""
+        if not self._pause_event.is_set():
+            # Пауза уже выставлена другой задачей — просто дожидаемся её окончания
+            await self._pause_event.wait()
+            return
+        logger.warning(f"Flood control: приостанавливаем рассылку на {retry_after} с")
+        self._pause_event.clear()
+        try:
+            await asyncio.sleep(retry_after + 0.5)
+        finally:
+            self._pause_event.set()
+    
     async def _send_single_message(
         self,
         user_id: int,
-        message: Message,
+        send: Callable[..., Awaitable[Any]],
         custom_keyboard: Optional[InlineKeyboardMarkup] = None
-    ) -> bool:
+    ) -> int:
         """
         Отправка одного сообщения пользователю
         
         Args:
             user_id: ID пользователя
-            message: Сообщение для отправки
+            send: Подготовленный метод отправки (copy_message исходного сообщения)
             custom_keyboard: Кастомная клавиатура
             
         Returns:
-            True если сообщение отправлено успешно
+            Код результата: SENT, BLOCKED или FAILED
         """
         try:
-            # Определяем тип сообщения и отправляем соответствующим методом
-            if message.text:
-                await self.bot.send_message(
-                    chat_id=user_id,
-                    text=message.text,
-                    reply_markup=custom_keyboard,
-                    parse_mode=message.html_text and "HTML" or None
-                )
-            elif message.photo:
-                await self.bot.send_photo(
-                    chat_id=user_id,
-                    photo=message.photo[-1].file_id,
-                    caption=message.caption,
-                    reply_markup=custom_keyboard,
-                    parse_mode=message.html_text and "HTML" or None
-                )
-            elif message.video:
-                await self.bot.send_video(
-                    chat_id=user_id,
-                    video=message.video.file_id,
-                    caption=message.caption,
-                    reply_markup=custom_keyboard,
-                    parse_mode=message.html_text and "HTML" or None
-                )
-            elif message.document:
-                await self.bot.send_document(
-                    chat_id=user_id,
-                    document=message.document.file_id,
-                    caption=message.caption,
-                    reply_markup=custom_keyboard,
-                    parse_mode=message.html_text and "HTML" or None
-                )
-            elif message.audio:
-                await self.bot.send_audio(
-                    chat_id=user_id,
-                    audio=message.audio.file_id,
-                    caption=message.caption,
-                    reply_markup=custom_keyboard,
-                    parse_mode=message.html_text and "HTML" or None
-                )
-            elif message.voice:
-                await self.bot.send_voice(
-                    chat_id=user_id,
-                    voice=message.voice.file_id,
-                    caption=message.caption,
-                    reply_markup=custom_keyboard,
-                    parse_mode=message.html_text and "HTML" or None
-                )
-            elif message.video_note:
-                await self.bot.send_video_note(
-                    chat_id=user_id,
-                    video_note=message.video_note.file_id,
-                    reply_markup=custom_keyboard
-                )
-            elif message.animation:
-                await self.bot.send_animation(
-                    chat_id=user_id,
-                    animation=message.animation.file_id,
-                    caption=message.caption,
-                    reply_markup=custom_keyboard,
-                    parse_mode=message.html_text and "HTML" or None
-                )
-            elif message.sticker:
-                await self.bot.send_sticker(
-                    chat_id=user_id,
-                    sticker=message.sticker.file_id,
-                    reply_markup=custom_keyboard
-                )
-            else:
-                # Если тип сообщения не поддерживается
-                return False
-            
-            return True
+            await send(chat_id=user_id, reply_markup=custom_keyboard)
+            return self.SENT
             
         except TelegramForbiddenError:
             # Пользователь заблокировал бота
-            logger.debug(f"Пользователь {user_id} заблокировал бота")
+            logger.debug("Пользователь {} заблокировал бота", user_id)
+            return self.BLOCKED
+        except TelegramRetryAfter:
+            # Flood control обрабатывается на уровне _send_with_limits
             raise
         except TelegramBadRequest as e:
             # Другие ошибки Telegram API
             logger.warning(f"Ошибка отправки пользователю {user_id}: {e}")
-            return False
+            return self.FAILED
         except Exception as e:
             # Неожиданные ошибки
             logger.error(f"Неожиданная ошибка при отправке пользователю {user_id}: {e}")
-            return False 
\ No newline at end of file
+            return self.FAILED
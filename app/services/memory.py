@@ -10,14 +10,66 @@
 """
 from __future__ import annotations
 
-import json
 import time
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
+import orjson
 from loguru import logger
 from redis import asyncio as aioredis
 
 from app.config import settings
+from app.services.redis_client import get_redis
+
+
+# Сводка, её стоимость в токенах и хвост истории за один round-trip (атомарно внутри Redis)
+_GET_CONTEXT_LUA = """
+local s = redis.call('GET', KEYS[1])
+local t = redis.call('GET', KEYS[3])
+local h = redis.call('LRANGE', KEYS[2], -tonumber(ARGV[1]), -1)
+return {s, h, t}
+"""
+
+# Заменить историю, только если с момента чтения она не менялась (та же длина и тот же последний элемент)
+_REPLACE_HISTORY_LUA = """
+if redis.call('LLEN', KEYS[1]) ~= tonumber(ARGV[1]) or redis.call('LINDEX', KEYS[1], -1) ~= ARGV[2] then
+  return 0
+end
+redis.call('DEL', KEYS[1])
+if #ARGV > 3 then
+  redis.call('RPUSH', KEYS[1], unpack(ARGV, 4))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# Удалить из начала истории уже обработанные сообщения (ARGV — они же, по порядку). Сообщения,
+# которые к этому моменту уже вытеснены из списка, пропускаются; всё, чего нет в ARGV, остаётся
+_DROP_HEAD_LUA = """
+local dropped = 0
+for i = 1, #ARGV do
+  if redis.call('LINDEX', KEYS[1], 0) == ARGV[i] then
+    redis.call('LPOP', KEYS[1])
+    dropped = dropped + 1
+  end
+end
+return dropped
+"""
+
+
+def _decode_items(raw: List[bytes]) -> List[Dict[str, Any]]:
+    """Разобрать элементы истории; битые элементы пропускаются."""
+    try:
+        # Быстрый путь: orjson читает bytes напрямую, без decode и per-item try
+        return [orjson.loads(item) for item in raw]
+    except orjson.JSONDecodeError:
+        pass
+    result: List[Dict[str, Any]] = []
+    for item in raw:
+        try:
+            result.append(orjson.loads(item))
+        except orjson.JSONDecodeError:
+            continue
+    return result
 
 
 class ConversationMemory:
@@ -28,12 +80,18 @@ class ConversationMemory:
     - Сводка:  f"chat:{chat_id}:summary" (тип: STRING)
     """
 
-    def __init__(self) -> None:
-        self.redis = aioredis.from_url(settings.redis_url, decode_responses=True)
+    def __init__(self, redis: Optional[aioredis.Redis] = None) -> None:
+        # По умолчанию — клиент поверх общего пула процесса (тот же, что у FSM-хранилища);
+        # ответы получаем как bytes: orjson разбирает их без промежуточного decode
+        self.redis = redis if redis is not None else get_redis()
         # TTL для ключей памяти (в секундах), продлевается при каждом добавлении сообщений
         self.ttl_seconds: int = 60 * 60 * 24 * 7  # 7 дней
         # Мягкие лимиты
         self.max_history_messages: int = settings.conversation_max_history_messages
+        # EVALSHA с автоматическим фоллбеком на EVAL при NOSCRIPT
+        self._get_context_script = self.redis.register_script(_GET_CONTEXT_LUA)
+        self._replace_history_script = self.redis.register_script(_REPLACE_HISTORY_LUA)
+        self._drop_head_script = self.redis.register_script(_DROP_HEAD_LUA)
 
     @staticmethod
     def _history_key(chat_id: int | str) -> str:
@@ -43,17 +101,28 @@ class ConversationMemory:
     def _summary_key(chat_id: int | str) -> str:
         return f"chat:{chat_id}:summary"
 
-    async def append_message(self, chat_id: int | str, role: str, content: str) -> None:
-        """Добавить сообщение в конец истории и обрезать при необходимости."""
+    @staticmethod
+    def _summary_tokens_key(chat_id: int | str) -> str:
+        return f"chat:{chat_id}:summary_tokens"
+
+    async def append_message(self, chat_id: int | str, role: str, content: str) -> Optional[Dict[str, Any]]:
+        """Добавить сообщение в конец истории и обрезать при необходимости.
+
+        Возвращает записанное сообщение (None — если записать не удалось).
+        """
         key = self._history_key(chat_id)
         message = {"role": role, "content": content, "ts": int(time.time())}
         try:
-            await self.redis.rpush(key, json.dumps(message, ensure_ascii=False))
-            await self.redis.expire(key, self.ttl_seconds)
-            # Мягкая обрезка по кол-ву сообщений
-            await self.redis.ltrim(key, -self.max_history_messages, -1)
+            # Один round-trip: добавление, продление TTL и мягкая обрезка по кол-ву сообщений
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.rpush(key, orjson.dumps(message))
+                pipe.expire(key, self.ttl_seconds)
+                pipe.ltrim(key, -self.max_history_messages, -1)
+                await pipe.execute()
+            return message
         except Exception as e:
             logger.error(f"Redis append_message error: {e}")
+            return None
 
     async def get_history(self, chat_id: int | str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
         """Вернуть последние N сообщений (по умолчанию весь лимит)."""
@@ -63,18 +132,36 @@ class ConversationMemory:
         try:
             # Берём хвост списка
             raw = await self.redis.lrange(key, -limit, -1)
-            result: List[Dict[str, Any]] = []
-            for item in raw:
-                try:
-                    result.append(json.loads(item))
-                except Exception:
-                    # Пропускаем битые элементы
-                    continue
-            return result
+            return _decode_items(raw)
         except Exception as e:
             logger.error(f"Redis get_history error: {e}")
             return []
 
+    async def get_context(
+        self, chat_id: int | str, limit: Optional[int] = None
+    ) -> Tuple[Optional[str], List[Dict[str, Any]]]:
+        """Вернуть (сводка, последние N сообщений) одним запросом к Redis."""
+        summary, _, history = await self.get_context_with_tokens(chat_id, limit)
+        return summary, history
+
+    async def get_context_with_tokens(
+        self, chat_id: int | str, limit: Optional[int] = None
+    ) -> Tuple[Optional[str], Optional[int], List[Dict[str, Any]]]:
+        """Вернуть (сводка, её стоимость в токенах или None, последние N сообщений) одним запросом."""
+        if limit is None:
+            limit = self.max_history_messages
+        try:
+            summary, raw, tokens = await self._get_context_script(
+                keys=[self._summary_key(chat_id), self._history_key(chat_id), self._summary_tokens_key(chat_id)],
+                args=[limit],
+            )
+        except Exception as e:
+            logger.error(f"Redis get_context error: {e}")
+            return None, None, []
+        if not summary:
+            return None, None, _decode_items(raw or [])
+        return summary.decode("utf-8"), (int(tokens) if tokens else None), _decode_items(raw or [])
+
     async def clear_history(self, chat_id: int | str) -> None:
         try:
             await self.redis.delete(self._history_key(chat_id))
@@ -85,30 +172,64 @@ class ConversationMemory:
         try:
             key = self._summary_key(chat_id)
             summary = await self.redis.get(key)
-            return summary if summary else None
+            return summary.decode("utf-8") if summary else None
         except Exception as e:
             logger.error(f"Redis get_summary error: {e}")
             return None
 
-    async def set_summary(self, chat_id: int | str, summary: str) -> None:
+    async def set_summary(self, chat_id: int | str, summary: str, tokens: Optional[int] = None) -> None:
+        """Сохранить сводку; tokens — заранее посчитанная стоимость сводки в промпте (если известна)."""
         try:
-            key = self._summary_key(chat_id)
-            await self.redis.set(key, summary, ex=self.ttl_seconds)
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.set(self._summary_key(chat_id), summary, ex=self.ttl_seconds)
+                # Старое значение токенов к новой сводке не относится — заменяем или удаляем
+                if tokens is not None:
+                    pipe.set(self._summary_tokens_key(chat_id), tokens, ex=self.ttl_seconds)
+                else:
+                    pipe.delete(self._summary_tokens_key(chat_id))
+                await pipe.execute()
         except Exception as e:
             logger.error(f"Redis set_summary error: {e}")
 
-    async def trim_to_last(self, chat_id: int | str, keep_last: int) -> None:
-        """Оставить только последние N сообщений в истории."""
-        key = self._history_key(chat_id)
+    async def replace_history(
+        self, chat_id: int | str, expected: List[Dict[str, Any]], messages: List[Dict[str, Any]]
+    ) -> bool:
+        """Заменить историю на messages, если она всё ещё совпадает с прочитанной ранее expected.
+
+        Возвращает False, если за это время в историю успели дописать сообщения (замена не выполнена).
+        """
+        if not expected:
+            return False
+        try:
+            replaced = await self._replace_history_script(
+                keys=[self._history_key(chat_id)],
+                args=[len(expected), orjson.dumps(expected[-1]), self.ttl_seconds,
+                      *(orjson.dumps(m) for m in messages)],
+            )
+            return bool(replaced)
+        except Exception as e:
+            logger.error(f"Redis replace_history error: {e}")
+            return False
+
+    async def drop_head(self, chat_id: int | str, messages: List[Dict[str, Any]]) -> None:
+        """Удалить из начала истории ровно эти сообщения (например, уже вошедшие в сводку).
+
+        Не зависит от того, сколько сообщений дописано с момента чтения:
+        новые сообщения не удаляются, даже если их много.
+        """
+        if not messages:
+            return
         try:
-            await self.redis.ltrim(key, -keep_last, -1)
-            await self.redis.expire(key, self.ttl_seconds)
+            await self._drop_head_script(
+                keys=[self._history_key(chat_id)],
+                args=[orjson.dumps(m) for m in messages],
+            )
         except Exception as e:
-            logger.error(f"Redis trim_to_last error: {e}")
+            logger.error(f"Redis drop_head error: {e}")
 
     async def clear_summary(self, chat_id: int | str) -> None:
         try:
-            await self.redis.delete(self._summary_key(chat_id))
+            await self.redis.delete(self._summary_key(chat_id), self._summary_tokens_key(chat_id))
         except Exception as e:
             logger.error(f"Redis clear_summary error: {e}")
 
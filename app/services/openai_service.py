@@ -3,17 +3,127 @@
 """
 from __future__ import annotations
 
-from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
-import contextlib
-import queue
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import accumulate
+from typing import Any, AsyncIterator, Coroutine, Dict, List, Optional, Set, Tuple
+import hashlib
 import asyncio
-
+import mimetypes
+import os
+import re
+import time
+import weakref
+
+import httpx
+from aiolimiter import AsyncLimiter
 from loguru import logger
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAIError
 
 from app.config import settings
 from app.services.memory import memory
-from app.services.tokenizer import count_messages_tokens
+from app.services.summary_batch import SummaryBatchQueue
+from app.services.tokenizer import count_single_message_tokens
+
+# Префикс developer-сообщения со сводкой предыдущего диалога
+_SUMMARY_PREFIX = (
+    "Краткая сводка предыдущего диалога для контекста. "
+    "Используй как фоновые факты, не повторяй её дословно в ответах.\n"
+)
+
+# Мягкий бюджет токенов на input запроса (instructions идут отдельно и сюда не входят)
+_MAX_PROMPT_TOKENS = 6000
+# Верхняя оценка служебных токенов сообщения (структура + роль) для быстрой проверки бюджета
+_MAX_MESSAGE_OVERHEAD = 8
+
+# Суммаризация истории: observer сжимает вытесняемые реплики в наблюдения,
+# reflector пересобирает разросшуюся сводку
+_OBSERVE_PROMPT_HEADER = (
+    "Выпиши 3–6 кратких наблюдений по фрагменту диалога: ключевые факты, намерения пользователя, "
+    "принятые решения, открытые вопросы. Каждое наблюдение с новой строки, начиная с «- ». "
+    "Пиши по-русски, без общих слов. Это будет использовано как контекст.\n"
+)
+_REFLECT_PROMPT_HEADER = (
+    "Ниже накопленные наблюдения по диалогу. Суммируй их кратко в 8–12 строках: ключевые факты, "
+    "намерения пользователя, принятые решения, открытые вопросы. Устаревшее и повторы убери. "
+    "Пиши по-русски, без общих слов.\n\n"
+)
+_SUMMARIZER_INSTRUCTIONS = "Ты помощник, делаешь краткие деловые сводки переписок."
+# Сколько последних сообщений остаётся в истории после сжатия
+_KEEP_LAST = 8
+# Порог размера сводки (в токенах), после которого включается reflector
+_REFLECT_SUMMARY_TOKENS = 800
+# Реплики ассистента во входе observer-а: ~20% длины, но не меньше этого числа символов
+_ASSISTANT_OBSERVE_MIN_CHARS = 200
+
+# Компактизация истории без LLM: формальные ответы-подтверждения ассистента удаляются целиком
+_ACK_RE = re.compile(
+    r"(?:хорошо|понял[аи]?|принято|ясно|ок|окей|ok|okay|отлично|договорились|спасибо|пожалуйста)[\s.,!)]*",
+    re.IGNORECASE,
+)
+_CODE_BLOCK_RE = re.compile(r"```.*?```", re.DOTALL)
+_TRAILING_SPACES_RE = re.compile(r"[ \t]+\n")
+_EXTRA_NEWLINES_RE = re.compile(r"\n{3,}")
+_CODE_BLOCK_STUB = "[фрагмент кода повторяется ниже]"
+# Компактизации достаточно, если после неё история занимает не больше этой доли окна
+_COMPACT_TARGET_RATIO = 0.75
+_ASSISTANT_PREFIX = "Ассистент: "
+_ROLE_PREFIXES = {"user": "Пользователь: ", "assistant": _ASSISTANT_PREFIX}
+
+# События стрима, после которых ответ считается неуспешным
+_STREAM_FAILURE_EVENTS = frozenset({"response.failed", "error"})
+
+
+@lru_cache(maxsize=4096)
+def _prompt_cache_key(chat_id: Optional[int | str]) -> str:
+    """Ключ Prompt Caching: свой для каждого диалога (стабильный префикс истории), общий — без чата."""
+    if chat_id is None:
+        return settings.openai_prompt_cache_key
+    digest = hashlib.blake2b(str(chat_id).encode("utf-8"), digest_size=8).hexdigest()
+    return f"{settings.openai_prompt_cache_key}:{digest}"
+
+
+def _slow_extract_text(response: Any) -> str:
+    """Сборка текста из output — только когда SDK не заполнил output_text."""
+    parts = (
+        getattr(content, "text", "")
+        for item in (response.output or [])
+        if getattr(item, "type", "") == "message"
+        for content in (item.content or [])
+        if getattr(content, "type", "") == "output_text"
+    )
+    return "\n".join(p for p in parts if p)
+
+
+def _dated(observations: str) -> str:
+    """Наблюдения с отметкой даты — по ней в сводке видно, к какому периоду они относятся."""
+    return f"[{time.strftime('%d.%m.%Y')}]\n{observations}"
+
+
+@lru_cache(maxsize=1)
+def _web_search_tool() -> Dict[str, Any]:
+    """Описание инструмента web_search из настроек (настройки не меняются во время работы)."""
+    ws_tool: Dict[str, Any] = {"type": "web_search_preview"}
+    # контекст размера
+    size = settings.openai_web_search_context_size
+    if size:
+        ws_tool["search_context_size"] = size
+    # геолокация
+    loc: Dict[str, Any] = {}
+    if settings.openai_web_search_country or settings.openai_web_search_city or settings.openai_web_search_region or settings.openai_web_search_timezone:
+        loc["type"] = "approximate"
+        if settings.openai_web_search_country:
+            loc["country"] = settings.openai_web_search_country
+        if settings.openai_web_search_city:
+            loc["city"] = settings.openai_web_search_city
+        if settings.openai_web_search_region:
+            loc["region"] = settings.openai_web_search_region
+        if settings.openai_web_search_timezone:
+            loc["timezone"] = settings.openai_web_search_timezone
+    if loc:
+        ws_tool["user_location"] = loc
+    return ws_tool
 
 
 class OpenAIService:
@@ -28,9 +138,42 @@ class OpenAIService:
     def __init__(self) -> None:
         if not settings.openai_api_key:
             logger.warning("OPENAI_API_KEY не задан. OpenAIService будет неактивен.")
-        self.client = OpenAI(api_key=settings.openai_api_key or None)
+        # Нативный async-клиент: запросы идут прямо из event loop, без пула потоков.
+        # Один HTTP/2-пул на процесс: запросы мультиплексируются по уже открытым соединениям
+        self.client = AsyncOpenAI(
+            api_key=settings.openai_api_key or None,
+            http_client=DefaultAsyncHttpxClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=256, max_keepalive_connections=64, keepalive_expiry=60),
+                timeout=httpx.Timeout(60, connect=5),
+            ),
+        )
         self.model = settings.openai_model
-        self.vector_store_id = settings.openai_vector_store_id or ""
+        self.set_vector_store(settings.openai_vector_store_id or "")
+        # Общие для всех методов лимиты: одновременные запросы и token bucket на RPM
+        self._sem = asyncio.Semaphore(settings.openai_max_concurrency or 16)
+        self._rpm = AsyncLimiter(settings.openai_rpm or 500, 60)
+        # Кэш уже загруженных PDF: (vector_store_id, digest) -> (время загрузки, file_id)
+        self._pdf_cache: "OrderedDict[Tuple[str, str], Tuple[float, str]]" = OrderedDict()
+        self._pdf_cache_max = 256
+        self._pdf_cache_ttl = 3600.0
+        # Чаты, для которых суммаризация уже выполняется, и ссылки на фоновые задачи (от GC)
+        self._summarizing: Set[int | str] = set()
+        # Блокировка сводки на чат: дописывание наблюдений — read-modify-write, обычная суммаризация
+        # и результаты Batch API не должны перетирать друг друга; неиспользуемые блокировки удаляются сами
+        self._summary_locks: "weakref.WeakValueDictionary[int | str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self._background: Set[asyncio.Task] = set()
+        # Суммаризация через Batch API (вдвое дешевле, результат — в пределах суток)
+        self._summary_batch: Optional[SummaryBatchQueue] = (
+            SummaryBatchQueue(
+                self.client,
+                self._summary_request_body,
+                on_result=self._on_batch_observations,
+                on_failed=self._on_batch_failed,
+            )
+            if settings.openai_summary_batch_enabled
+            else None
+        )
 
     # -------------------- Public API --------------------
     async def answer_question(
@@ -46,41 +189,13 @@ class OpenAIService:
         Если включён use_file_search и настроен vector_store, модель использует поиск по документам.
         Если передан chat_id, будет добавлен недавний контекст и сводка, а ответ запишется в память.
         """
-        tools: List[Dict[str, Any]] = []
-        if use_file_search and self.vector_store_id:
-            tools.append({
-                "type": "file_search",
-                "vector_store_ids": [self.vector_store_id],
-            })
-
-        # Опциональный веб-поиск: либо включается явно, либо берётся из настроек
-        enable_web_search = settings.openai_enable_web_search if use_web_search is None else use_web_search
-        if enable_web_search:
-            ws_tool: Dict[str, Any] = {"type": "web_search_preview"}
-            # контекст размера
-            size = settings.openai_web_search_context_size
-            if size:
-                ws_tool["search_context_size"] = size
-            # геолокация
-            loc: Dict[str, Any] = {}
-            if settings.openai_web_search_country or settings.openai_web_search_city or settings.openai_web_search_region or settings.openai_web_search_timezone:
-                loc["type"] = "approximate"
-                if settings.openai_web_search_country:
-                    loc["country"] = settings.openai_web_search_country
-                if settings.openai_web_search_city:
-                    loc["city"] = settings.openai_web_search_city
-                if settings.openai_web_search_region:
-                    loc["region"] = settings.openai_web_search_region
-                if settings.openai_web_search_timezone:
-                    loc["timezone"] = settings.openai_web_search_timezone
-            if loc:
-                ws_tool["user_location"] = loc
-            tools.append(ws_tool)
+        tools = self._build_tools(use_file_search, use_web_search)
 
         # Строим ввод с памятью
         input_messages: List[Dict[str, Any]]
+        history: Optional[List[Dict[str, Any]]] = None
         if chat_id is not None:
-            input_messages = await self._build_messages_with_memory(chat_id=chat_id, user_text=question)
+            input_messages, history = await self._build_messages_with_memory(chat_id=chat_id, user_text=question)
         else:
             input_messages = [{"role": "user", "content": question}]
 
@@ -88,48 +203,28 @@ class OpenAIService:
         input_messages = self._add_proofread_hint(input_messages)
 
         try:
-            # Выполняем синхронный SDK-вызов в отдельном потоке, чтобы не блокировать event loop
-            response = await asyncio.to_thread(
-                self.client.responses.create,
-                model=self.model,
-                input=input_messages,
-                tools=tools or None,
-                instructions=settings.openai_instructions,
-                prompt_cache_key=settings.openai_prompt_cache_key,
-                **self._sampling_kwargs(),
-            )
+            async with self._sem, self._rpm:
+                response = await self.client.responses.create(
+                    model=self.model,
+                    input=input_messages,
+                    tools=tools or None,
+                    instructions=settings.openai_instructions,
+                    prompt_cache_key=_prompt_cache_key(chat_id),
+                    **self._sampling_kwargs(),
+                )
         except Exception as e:
             logger.error(f"Ошибка запроса к OpenAI: {e}")
             raise
 
-        # Безопасно агрегируем текст
-        try:
-            text = getattr(response, "output_text", None)
-            if not text:
-                # Фоллбек на разбор output
-                text_parts: List[str] = []
-                for item in (response.output or []):
-                    if getattr(item, "type", "") == "message":
-                        for content in (item.content or []):
-                            if getattr(content, "type", "") == "output_text":
-                                text_parts.append(getattr(content, "text", ""))
-                text = "\n".join([p for p in text_parts if p]) or ""
-        except Exception:
-            text = ""
+        text = self._extract_text(response)
 
         # Пост-вычитка ответа (опционально)
         if text:
             text = await self._maybe_proofread(text)
 
-        # Обновляем память
+        # Обновляем память (в фоне, ответ пользователю не ждёт записи)
         if chat_id is not None and text:
-            try:
-                await memory.append_message(chat_id, "user", question)
-                await memory.append_message(chat_id, "assistant", text)
-                # При слишком длинных цепочках периодически делаем сводку
-                await self._maybe_summarize(chat_id)
-            except Exception as e:
-                logger.warning(f"Не удалось обновить память диалога: {e}")
+            self._persist_turn(chat_id, question, text, history=history)
 
         return text or ""  # Пусть будет пустая строка, обработаем на уровне хендлера
 
@@ -152,41 +247,48 @@ class OpenAIService:
 
         user_prompt = (question or "Опиши изображение и ответь на возможные вопросы по нему. Пиши по-русски.").strip()
 
+        # Загрузка изображения и чтение памяти не зависят друг от друга — выполняем параллельно.
+        # Если загрузка не удалась, чтение памяти отменяем: его результат уже не нужен
+        context_task = asyncio.create_task(memory.get_context(chat_id)) if chat_id is not None else None
+
         # Загружаем изображение в Files API с purpose="vision"
+        error: Optional[str] = None
         try:
-            file_obj = await asyncio.to_thread(
-                self.client.files.create,
-                file=open(image_path, "rb"),
-                purpose="vision",
-            )
+            with open(image_path, "rb") as f:
+                async with self._sem, self._rpm:
+                    file_obj = await self.client.files.create(
+                        file=(os.path.basename(image_path), f, mimetypes.guess_type(image_path)[0] or "image/jpeg"),
+                        purpose="vision",
+                    )
             file_id = getattr(file_obj, "id", None)
             if not file_id:
-                return "Не удалось подготовить изображение для анализа."
+                error = "Не удалось подготовить изображение для анализа."
         except Exception as e:
             logger.error(f"Ошибка загрузки изображения в OpenAI Files: {e}")
-            return "Не удалось загрузить изображение для анализа."
+            error = "Не удалось загрузить изображение для анализа."
+        if error is not None:
+            if context_task is not None:
+                context_task.cancel()
+            return error
 
         # Собираем сообщения с учётом памяти
         messages: List[Dict[str, Any]] = []
-        if chat_id is not None:
+        history: Optional[List[Dict[str, Any]]] = None
+        if context_task is not None:
             try:
-                summary = await memory.get_summary(chat_id)
+                summary, history = await context_task
                 if summary:
                     messages.append({
                         "role": "developer",
-                        "content": (
-                            "Краткая сводка предыдущего диалога для контекста. "
-                            "Используй как фоновые факты, не повторяй её дословно в ответах.\n" + summary
-                        ),
+                        "content": _SUMMARY_PREFIX + summary,
                     })
-                history = await memory.get_history(chat_id)
                 for msg in history:
                     role = msg.get("role")
                     content = msg.get("content")
                     if role in ("user", "assistant") and isinstance(content, str):
                         messages.append({"role": role, "content": content})
             except Exception as e:
-                logger.debug(f"Не удалось добавить контекст памяти к vision-запросу: {e}")
+                logger.debug("Не удалось добавить контекст памяти к vision-запросу: {}", e)
 
         # Финальное пользовательское сообщение с изображением
         image_item: Dict[str, Any] = {"type": "input_image", "file_id": file_id}
@@ -205,44 +307,27 @@ class OpenAIService:
         messages = self._add_proofread_hint(messages)
 
         try:
-            response = await asyncio.to_thread(
-                self.client.responses.create,
-                model=self.model,
-                input=messages,
-                instructions=settings.openai_instructions,
-                prompt_cache_key=settings.openai_prompt_cache_key,
-                **self._sampling_kwargs(),
-            )
+            async with self._sem, self._rpm:
+                response = await self.client.responses.create(
+                    model=self.model,
+                    input=messages,
+                    instructions=settings.openai_instructions,
+                    prompt_cache_key=_prompt_cache_key(chat_id),
+                    **self._sampling_kwargs(),
+                )
         except Exception as e:
             logger.error(f"Ошибка vision-запроса к OpenAI: {e}")
             return "Произошла ошибка при анализе изображения."
 
-        # Извлекаем текст
-        try:
-            text = getattr(response, "output_text", None) or ""
-            if not text:
-                parts: List[str] = []
-                for item in (response.output or []):
-                    if getattr(item, "type", "") == "message":
-                        for content in (item.content or []):
-                            if getattr(content, "type", "") == "output_text":
-                                parts.append(getattr(content, "text", ""))
-                text = "\n".join([p for p in parts if p])
-        except Exception:
-            text = ""
+        text = self._extract_text(response)
 
         # Пост-вычитка ответа (опционально)
         if text:
             text = await self._maybe_proofread(text)
 
-        # Обновляем память
+        # Обновляем память (в фоне)
         if chat_id is not None and text:
-            try:
-                await memory.append_message(chat_id, "user", f"[изображение] {user_prompt}")
-                await memory.append_message(chat_id, "assistant", text)
-                await self._maybe_summarize(chat_id)
-            except Exception as e:
-                logger.warning(f"Не удалось обновить память диалога (vision): {e}")
+            self._persist_turn(chat_id, f"[изображение] {user_prompt}", text, history=history)
 
         return text or ""
 
@@ -276,112 +361,63 @@ class OpenAIService:
             return
 
         # Собираем инструменты и сообщения (как в обычном вызове)
-        tools: List[Dict[str, Any]] = []
-        if use_file_search and self.vector_store_id:
-            tools.append({
-                "type": "file_search",
-                "vector_store_ids": [self.vector_store_id],
-            })
-
-        enable_web_search = settings.openai_enable_web_search if use_web_search is None else use_web_search
-        if enable_web_search:
-            ws_tool: Dict[str, Any] = {"type": "web_search_preview"}
-            size = settings.openai_web_search_context_size
-            if size:
-                ws_tool["search_context_size"] = size
-            loc: Dict[str, Any] = {}
-            if settings.openai_web_search_country or settings.openai_web_search_city or settings.openai_web_search_region or settings.openai_web_search_timezone:
-                loc["type"] = "approximate"
-                if settings.openai_web_search_country:
-                    loc["country"] = settings.openai_web_search_country
-                if settings.openai_web_search_city:
-                    loc["city"] = settings.openai_web_search_city
-                if settings.openai_web_search_region:
-                    loc["region"] = settings.openai_web_search_region
-                if settings.openai_web_search_timezone:
-                    loc["timezone"] = settings.openai_web_search_timezone
-            if loc:
-                ws_tool["user_location"] = loc
-            tools.append(ws_tool)
+        tools = self._build_tools(use_file_search, use_web_search)
 
+        history: Optional[List[Dict[str, Any]]] = None
         if chat_id is not None:
-            input_messages = await self._build_messages_with_memory(chat_id=chat_id, user_text=question)
+            input_messages, history = await self._build_messages_with_memory(chat_id=chat_id, user_text=question)
         else:
             input_messages = [{"role": "user", "content": question}]
 
         # Подсказка о вычитке для снижения опечаток
         input_messages = self._add_proofread_hint(input_messages)
 
-        # Мостик потоковых событий SDK → асинхронный итератор (через threadsafe очередь)
-        q: "queue.Queue[Tuple[str, Optional[str]]]" = queue.Queue()
-        SENTINEL_DONE: Tuple[str, Optional[str]] = ("done", None)
-        SENTINEL_ERROR: Tuple[str, Optional[str]] = ("error", None)
         full_answer_parts: List[str] = []
-
-        def _worker() -> None:
-            try:
-                stream = self.client.responses.create(
-                    model=self.model,
-                    input=input_messages,
-                    tools=tools or None,
-                    instructions=settings.openai_instructions,
-                    prompt_cache_key=settings.openai_prompt_cache_key,
-                    stream=True,
-                    **self._sampling_kwargs(),
-                )
-                for event in stream:
-                    try:
-                        ev_type = getattr(event, "type", None) or getattr(event, "event", "") or ""
-                        if isinstance(ev_type, str) and "response.output_text.delta" in ev_type:
-                            # В разных версиях SDK свойство может называться по-разному
-                            delta = getattr(event, "delta", None) or getattr(event, "text", None) or getattr(event, "output_text_delta", None)
-                            if isinstance(delta, str) and delta:
-                                full_answer_parts.append(delta)
-                                q.put(("delta", delta))
-                        elif isinstance(ev_type, str) and (ev_type.endswith("response.completed") or ev_type == "response.completed"):
-                            q.put(SENTINEL_DONE)
-                            break
-                        elif isinstance(ev_type, str) and ("failed" in ev_type or ev_type == "error"):
-                            q.put(SENTINEL_ERROR)
-                            break
-                    except Exception:
-                        # Игнорируем частные ошибки обработки отдельных событий
-                        continue
-                else:
-                    # Если цикл завершился без явного completed — всё равно завершим
-                    q.put(SENTINEL_DONE)
-            except Exception as e:
-                logger.error(f"Ошибка стриминга OpenAI: {e}")
-                with contextlib.suppress(Exception):
-                    q.put(SENTINEL_ERROR)
-
-        # Запускаем воркер в отдельном потоке
-        bg = asyncio.create_task(asyncio.to_thread(_worker))
-
         try:
-            while True:
-                # Блокирующее ожидание элемента изочереди в отдельном потоке
-                kind, payload = await asyncio.to_thread(q.get)
-                if (kind, payload) == SENTINEL_DONE:
-                    break
-                if (kind, payload) == SENTINEL_ERROR:
-                    # Прерываем без текста; память не обновляем
-                    return
-                if kind == "delta" and isinstance(payload, str):
-                    yield payload
-        finally:
-            with contextlib.suppress(Exception):
-                await bg
+            async with self._sem, self._rpm, self.client.responses.stream(
+                model=self.model,
+                input=input_messages,
+                instructions=settings.openai_instructions,
+                prompt_cache_key=_prompt_cache_key(chat_id),
+                # stream() перебирает tools без проверки на None — без инструментов параметр не передаём
+                **({"tools": tools} if tools else {}),
+                **self._sampling_kwargs(),
+            ) as stream:
+                # Типизированные события SDK: сравниваем type напрямую, без разбора строк
+                async for event in stream:
+                    if event.type == "response.output_text.delta":
+                        if event.delta:
+                            full_answer_parts.append(event.delta)
+                            yield event.delta
+                    elif event.type == "response.completed":
+                        break
+                    elif event.type in _STREAM_FAILURE_EVENTS:
+                        # Прерываем без текста; память не обновляем
+                        return
+        except OpenAIError as e:
+            logger.error(f"Ошибка стриминга OpenAI: {e}")
+            return
 
         # По завершении — обновляем память целым ответом
         if chat_id is not None and full_answer_parts:
-            final_text = "".join(full_answer_parts)
-            try:
-                await memory.append_message(chat_id, "user", question)
-                await memory.append_message(chat_id, "assistant", final_text)
-                await self._maybe_summarize(chat_id)
-            except Exception as e:
-                logger.warning(f"Не удалось обновить память диалога (stream): {e}")
+            self._persist_turn(chat_id, question, "".join(full_answer_parts), history=history)
+
+    @staticmethod
+    def _extract_text(response: Any) -> str:
+        """Текст ответа Responses API: output_text, а при его отсутствии — сборка из output."""
+        try:
+            return getattr(response, "output_text", None) or _slow_extract_text(response)
+        except Exception:
+            return ""
+
+    def _build_tools(self, use_file_search: bool, use_web_search: Optional[bool]) -> List[Dict[str, Any]]:
+        """Список инструментов запроса: file_search по vector store и опциональный веб-поиск."""
+        tools: List[Dict[str, Any]] = list(self._file_search_tool) if use_file_search else []
+        # Опциональный веб-поиск: либо включается явно, либо берётся из настроек
+        enable_web_search = settings.openai_enable_web_search if use_web_search is None else use_web_search
+        if enable_web_search:
+            tools.append(_web_search_tool())
+        return tools
 
     def _add_proofread_hint(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """При необходимости добавляет developer-подсказку о вычитке.
@@ -415,25 +451,25 @@ class OpenAIService:
             return text
 
         try:
-            response = await asyncio.to_thread(
-                self.client.responses.create,
-                model=self.model,
-                instructions=(
-                    "Вы корректируете орфографию и пунктуацию в русском тексте, сохраняя форматирование и смысл. "
-                    "Ничего не добавляйте от себя. Верните только исправленный текст."
-                ),
-                input=[
-                    {"role": "developer", "content": "Исправь орфографию, пунктуацию и опечатки. Смысл и факты не меняй."},
-                    {"role": "user", "content": text},
-                ],
-                prompt_cache_key=settings.openai_prompt_cache_key,
-                temperature=0.0,
-                top_p=1.0,
-            )
+            async with self._sem, self._rpm:
+                response = await self.client.responses.create(
+                    model=self.model,
+                    instructions=(
+                        "Вы корректируете орфографию и пунктуацию в русском тексте, сохраняя форматирование и смысл. "
+                        "Ничего не добавляйте от себя. Верните только исправленный текст."
+                    ),
+                    input=[
+                        {"role": "developer", "content": "Исправь орфографию, пунктуацию и опечатки. Смысл и факты не меняй."},
+                        {"role": "user", "content": text},
+                    ],
+                    prompt_cache_key=settings.openai_prompt_cache_key,
+                    temperature=0.0,
+                    top_p=1.0,
+                )
             fixed = getattr(response, "output_text", "") or ""
             return fixed.strip() or text
         except Exception as e:
-            logger.debug(f"Пост-вычитка не выполнена: {e}")
+            logger.debug("Пост-вычитка не выполнена: {}", e)
             return text
 
     async def transcribe_audio(
@@ -452,18 +488,19 @@ class OpenAIService:
         if not self.client.api_key:  # type: ignore[attr-defined]
             return "OpenAI не сконфигурирован. Обратитесь к администратору."
 
-        def _do_call(use_model: str):
+        async def _do_call(use_model: str):
             stt_resp_format = response_format or settings.openai_stt_response_format or "text"
             with open(file_path, "rb") as f:
-                return self.client.audio.transcriptions.create(
-                    model=use_model,
-                    file=f,
-                    response_format=stt_resp_format,
-                    prompt=(prompt or settings.openai_stt_prompt or None),
-                    language=(language or settings.openai_stt_language or None),
-                )
-
-        def _extract_text(res: Any) -> str:
+                async with self._sem, self._rpm:
+                    return await self.client.audio.transcriptions.create(
+                        model=use_model,
+                        file=(os.path.basename(file_path), f),
+                        response_format=stt_resp_format,
+                        prompt=(prompt or settings.openai_stt_prompt or None),
+                        language=(language or settings.openai_stt_language or None),
+                    )
+
+        def _stt_text(res: Any) -> str:
             try:
                 if isinstance(res, str):
                     return res.strip()
@@ -481,15 +518,15 @@ class OpenAIService:
         primary_model = model or settings.openai_stt_model
         try:
             logger.info(f"STT: start transcribe file={file_path} model={primary_model}")
-            result = await asyncio.to_thread(_do_call, primary_model)
-            text = _extract_text(result)
+            result = await _do_call(primary_model)
+            text = _stt_text(result)
             if text:
                 return text
             logger.warning(f"STT: empty result with model={primary_model}; will try whisper-1 fallback")
             # Фоллбек на whisper-1, если основной снапшот не дал текста
             fallback_model = "whisper-1"
-            result2 = await asyncio.to_thread(_do_call, fallback_model)
-            text2 = _extract_text(result2)
+            result2 = await _do_call(fallback_model)
+            text2 = _stt_text(result2)
             if text2:
                 logger.info("STT: fallback whisper-1 succeeded")
                 return text2
@@ -499,26 +536,28 @@ class OpenAIService:
             logger.error(f"Ошибка транскрибации аудио '{file_path}': {e}")
             return ""
 
-    async def _build_messages_with_memory(self, chat_id: int | str, user_text: str) -> List[Dict[str, Any]]:
-        """Формируем массив сообщений (developer+summary+history+current).
+    async def _build_messages_with_memory(
+        self, chat_id: int | str, user_text: str
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Формируем массив сообщений (developer+summary+history+current) и возвращаем его вместе с историей.
+
+        Прочитанная история передаётся дальше в _persist_turn, чтобы не читать её из Redis повторно.
 
         Оптимизация для Prompt Caching: инструкции идут отдельно (instructions),
-        а в input помещаем краткую сводку и недавнюю историю.
+        а в input помещаем краткую сводку и недавнюю историю. Порядок — от неизменного к изменчивому:
+        сводка меняется редко и идёт первой, история и текущий вопрос дописываются в хвост,
+        поэтому префикс запроса совпадает с предыдущим ходом и попадает в кэш.
         """
         messages: List[Dict[str, Any]] = []
-        # 1) Добавляем краткую сводку, если есть
-        summary = await memory.get_summary(chat_id)
+        # 1) Добавляем краткую сводку, если есть (сводка и история читаются одним запросом)
+        summary, summary_tokens, history = await memory.get_context_with_tokens(chat_id)
         if summary:
             messages.append({
                 "role": "developer",
-                "content": (
-                    "Краткая сводка предыдущего диалога для контекста. "
-                    "Используй как фоновые факты, не повторяй её дословно в ответах.\n" + summary
-                ),
+                "content": _SUMMARY_PREFIX + summary,
             })
 
         # 2) Добавляем несколько последних сообщений истории
-        history = await memory.get_history(chat_id)
         for msg in history:
             role = msg.get("role")
             content = msg.get("content")
@@ -527,72 +566,283 @@ class OpenAIService:
 
         # 3) Текущий запрос пользователя
         messages.append({"role": "user", "content": user_text})
-        
+
+        # Быстрый путь для коротких диалогов: токен — минимум один байт UTF-8 (≤ 4 байт на символ),
+        # так что если даже эта верхняя оценка укладывается в бюджет, подсчёт токенов и обрезка не нужны
+        upper_bound = sum(len(m["content"]) for m in messages) * 4 + _MAX_MESSAGE_OVERHEAD * len(messages)
+        if upper_bound <= _MAX_PROMPT_TOKENS:
+            return messages, history
+
         # Контроль бюджета токенов: если подсчёт слишком большой, удаляем самые старые элементы истории,
         # оставляя сводку и последние реплики.
         try:
-            max_prompt_tokens = 6000  # мягкий бюджет для запроса (зависит от модели)
-            # instructions идут отдельно, поэтому здесь считаем только messages
-            while len(messages) > 2 and count_messages_tokens(messages, self.model) > max_prompt_tokens:
-                # Удаляем первый после developer-сводки (если есть), иначе самый старый
-                # Найдём индекс первого не-developer сообщения
-                first_idx = 0
-                if messages and messages[0].get("role") == "developer":
-                    first_idx = 1
-                # Если остаётся только пользовательский текущий ввод — остановимся
-                if len(messages) - first_idx <= 1:
-                    break
-                del messages[first_idx]
+            # instructions идут отдельно, поэтому здесь считаем только messages.
+            # Каждое сообщение считаем один раз и дальше только вычитаем удалённые.
+            if summary_tokens is not None:
+                # Стоимость сводки посчитана при её сохранении — не кодируем длинный текст заново
+                per_msg = [summary_tokens] + [count_single_message_tokens(m, self.model) for m in messages[1:]]
+            else:
+                per_msg = [count_single_message_tokens(m, self.model) for m in messages]
+            total = sum(per_msg)
+            if total > _MAX_PROMPT_TOKENS:
+                # Удаляем самые старые после developer-сводки (если есть); минимум два сообщения
+                # остаются, текущий ввод пользователя (последний элемент) не трогаем.
+                # Сколько удалить — находим бинарным поиском по префиксным суммам.
+                first_idx = 1 if messages[0]["role"] == "developer" else 0
+                max_drop = len(messages) - 2
+                cum = list(accumulate(per_msg[first_idx:first_idx + max_drop], initial=0))
+                drop = min(bisect_left(cum, total - _MAX_PROMPT_TOKENS), max_drop)
+                del messages[first_idx:first_idx + drop]
         except Exception as e:
-            logger.debug(f"Не удалось оценить/обрезать токены: {e}")
+            logger.debug("Не удалось оценить/обрезать токены: {}", e)
+
+        return messages, history
+
+    def _spawn(self, coro: Coroutine[Any, Any, None]) -> asyncio.Task:
+        """Запустить фоновую задачу, удерживая ссылку на неё до завершения."""
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    def _persist_turn(
+        self,
+        chat_id: int | str,
+        user_text: str,
+        answer: str,
+        *,
+        history: Optional[List[Dict[str, Any]]] = None,
+    ) -> asyncio.Task:
+        """Записать реплику пользователя и ответ в память фоновой задачей.
 
-        return messages
+        history — история, прочитанная при построении запроса (если есть).
+        """
+        return self._spawn(self._do_persist(chat_id, user_text, answer, history))
 
-    async def _maybe_summarize(self, chat_id: int | str) -> None:
-        """Периодически преобразуем длинную историю в компактную сводку.
+    async def _do_persist(
+        self,
+        chat_id: int | str,
+        user_text: str,
+        answer: str,
+        history: Optional[List[Dict[str, Any]]],
+    ) -> None:
+        try:
+            user_msg = await memory.append_message(chat_id, "user", user_text)
+            answer_msg = await memory.append_message(chat_id, "assistant", answer)
+            if history is not None and user_msg and answer_msg:
+                # Историю после записи собираем из уже прочитанной, без повторного LRANGE;
+                # пока окно не заполнено, суммаризация не нужна и задачу не запускаем
+                max_messages = settings.conversation_max_history_messages
+                history = [*history, user_msg, answer_msg][-max_messages:]
+                if len(history) < max_messages:
+                    return
+            else:
+                history = None
+            # При слишком длинных цепочках периодически делаем сводку (в фоне)
+            self._schedule_summarize(chat_id, history)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить память диалога: {e}")
 
-        Стратегия: если история превышает ~1.5x max_history_messages, попросим модель
-        сделать краткую сводку и сохраним её. После этого обрежем историю до последних 8 сообщений.
+    def _summary_tokens(self, summary: str) -> Optional[int]:
+        """Стоимость developer-сообщения со сводкой в токенах (считается вне пути ответа)."""
+        try:
+            return count_single_message_tokens({"role": "developer", "content": _SUMMARY_PREFIX + summary}, self.model)
+        except Exception as e:
+            logger.debug("Не удалось посчитать токены сводки: {}", e)
+            return None
+
+    async def drain(self) -> None:
+        """Дождаться фоновых записей в память и суммаризаций (для корректной остановки)."""
+        while self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+
+    def start(self) -> None:
+        """Запустить фоновые очереди сервиса (вызывается при старте бота)."""
+        if self._summary_batch is not None:
+            self._summary_batch.start()
+
+    async def shutdown(self) -> None:
+        """Дождаться фоновых задач и закрыть HTTP-пул клиента."""
+        if self._summary_batch is not None:
+            # Накопленные запросы отправляются; отправленные задания опрашиваются после перезапуска
+            await self._summary_batch.stop()
+        await self.drain()
+        await self.client.close()
+
+    def _summary_lock(self, chat_id: int | str) -> asyncio.Lock:
+        lock = self._summary_locks.get(chat_id)
+        if lock is None:
+            lock = self._summary_locks[chat_id] = asyncio.Lock()
+        return lock
+
+    def _schedule_summarize(self, chat_id: int | str, history: Optional[List[Dict[str, Any]]] = None) -> None:
+        """Суммаризация вне пути ответа пользователю; не более одной на чат одновременно."""
+        if chat_id in self._summarizing:
+            return
+        self._summarizing.add(chat_id)
+        task = self._spawn(self._maybe_summarize(chat_id, history))
+        task.add_done_callback(lambda _: self._summarizing.discard(chat_id))
+
+    async def _maybe_summarize(self, chat_id: int | str, history: Optional[List[Dict[str, Any]]] = None) -> None:
+        """Периодически сжимаем длинную историю в компактную сводку (observer + reflector).
+
+        Стратегия: когда окно истории заполнено, сначала пробуем компактизацию без LLM
+        (_compact_history). Если она не освобождает достаточно места, observer сжимает в короткие
+        датированные наблюдения только вытесняемую часть (всё, кроме последних _KEEP_LAST сообщений)
+        и дописывает их к сводке; учтённые в сводке сообщения удаляются из истории.
+        Когда сводка перерастает _REFLECT_SUMMARY_TOKENS, reflector пересобирает её в 8–12 строк.
+        С OPENAI_SUMMARY_BATCH_ENABLED запрос observer-а уходит в Batch API: наблюдения дописываются
+        к сводке, а учтённые сообщения удаляются из истории, когда batch будет готов.
+        history — текущая история, если она уже известна вызывающему (иначе читается из Redis).
         """
         try:
-            history = await memory.get_history(chat_id, limit=settings.conversation_max_history_messages * 2)
-            if len(history) < int(settings.conversation_max_history_messages * 1.5):
+            if self._summary_batch is not None and self._summary_batch.is_pending(chat_id):
+                # Пока batch по чату не выполнен, историю не трогаем: её начало ещё ждёт сводки
+                return
+            if history is None:
+                history = await memory.get_history(chat_id)
+            if len(history) < settings.conversation_max_history_messages:
                 return
 
-            # Формируем простой запрос на суммаризацию
-            convo_text = []
-            for msg in history:
-                role = msg.get("role")
-                content = msg.get("content")
-                if not isinstance(content, str):
-                    continue
-                prefix = "Пользователь:" if role == "user" else "Ассистент:"
-                convo_text.append(f"{prefix} {content}")
-            prompt = (
-                "Суммируй диалог кратко в 8–12 строках: ключевые факты, намерения пользователя, принятые решения, "+
-                "открытые вопросы. Пиши по-русски, без общих слов. Это будет использовано как контекст.\n\n" +
-                "\n".join(convo_text)
-            )
+            # Сначала дешёвая компактизация без LLM: если она освободила достаточно места — сводка не нужна
+            # (если историю успели дополнить — замена не пройдёт, повторим на следующем ходе)
+            compacted = self._compact_history(history)
+            if len(compacted) <= settings.conversation_max_history_messages * _COMPACT_TARGET_RATIO:
+                await memory.replace_history(chat_id, history, compacted)
+                return
 
-            response = await asyncio.to_thread(
-                self.client.responses.create,
-                model=self.model,
-                reasoning={"effort": "low"},
-                instructions="Ты помощник, делаешь краткие деловые сводки переписок.",
-                input=[{"role": "user", "content": prompt}],
-                prompt_cache_key=settings.openai_prompt_cache_key,
-            )
-            summary_text = getattr(response, "output_text", "") or ""
-            if summary_text:
-                await memory.set_summary(chat_id, summary_text)
-                await memory.trim_to_last(chat_id, keep_last=8)
+            evicted = self._compact_history(history[:-_KEEP_LAST])
+            if self._summary_batch is not None:
+                prompt = self._observe_prompt(evicted)
+                if prompt:
+                    # История обрезается только после того, как сводка по batch-результату сохранена
+                    self._summary_batch.enqueue(chat_id, prompt, history[:-_KEEP_LAST])
+                return
+
+            observations = await self._observe(evicted)
+            if not observations:
+                return
+            await self._append_observations(chat_id, observations)
+            # Удаляем именно то, что вошло в сводку: пока шёл запрос к модели, в историю могли дописать
+            # новые сообщения, и обрезка «до последних N» выбросила бы часть ещё не учтённых
+            await memory.drop_head(chat_id, history[:-_KEEP_LAST])
         except Exception as e:
-            logger.debug(f"Суммаризация не выполнена: {e}")
+            logger.debug("Суммаризация не выполнена: {}", e)
+
+    async def _append_observations(self, chat_id: int | str, observations: str) -> None:
+        """Дописать наблюдения к сводке; разросшуюся сводку пересобрать reflector-ом."""
+        async with self._summary_lock(chat_id):
+            summary = await memory.get_summary(chat_id)
+            summary = f"{summary}\n{observations}" if summary else observations
+            tokens = self._summary_tokens(summary)
+
+            if tokens is not None and tokens > _REFLECT_SUMMARY_TOKENS:
+                reflected = await self._reflect(summary)
+                if reflected:
+                    summary, tokens = reflected, self._summary_tokens(reflected)
+
+            await memory.set_summary(chat_id, summary, tokens)
+
+    async def _on_batch_observations(self, chat_id: int | str, text: str, messages: List[Dict[str, Any]]) -> None:
+        try:
+            await self._append_observations(chat_id, _dated(text))
+            await memory.drop_head(chat_id, messages)
+        except Exception as e:
+            logger.debug("Не удалось применить сводку из batch: {}", e)
+
+    async def _on_batch_failed(self, chat_id: int | str, prompt: str, messages: List[Dict[str, Any]]) -> None:
+        # Batch не выполнился — суммаризируем обычным запросом
+        try:
+            text = await self._summarize_call(prompt)
+            if text:
+                await self._append_observations(chat_id, _dated(text))
+                await memory.drop_head(chat_id, messages)
+        except Exception as e:
+            logger.debug("Суммаризация не выполнена: {}", e)
+
+    @staticmethod
+    def _compact_history(history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Сжать историю дословно, без LLM: убрать малозначимое, не перефразируя остальное.
+
+        - ответы ассистента, состоящие только из подтверждения («Хорошо», «Понял» и т.п.), удаляются;
+        - повторяющиеся блоки кода остаются только в последнем вхождении, ранние заменяются заглушкой;
+        - лишние пробелы в концах строк и пустые строки подряд убираются.
+        Точные строки (коды ошибок, номера, идентификаторы) сохраняются как есть.
+        """
+        seen_blocks: Set[bytes] = set()
+
+        def _dedup_block(match: "re.Match[str]") -> str:
+            digest = hashlib.blake2b(match.group(0).encode("utf-8"), digest_size=8).digest()
+            if digest in seen_blocks:
+                return _CODE_BLOCK_STUB
+            seen_blocks.add(digest)
+            return match.group(0)
+
+        compacted: List[Dict[str, Any]] = []
+        # С конца: при повторе кода остаётся самое свежее вхождение
+        for msg in reversed(history):
+            content = msg.get("content")
+            if not isinstance(content, str):
+                compacted.append(msg)
+                continue
+            if msg.get("role") == "assistant" and _ACK_RE.fullmatch(content.strip()):
+                continue
+            if "```" in content:
+                content = _CODE_BLOCK_RE.sub(_dedup_block, content)
+            content = _EXTRA_NEWLINES_RE.sub("\n\n", _TRAILING_SPACES_RE.sub("\n", content)).strip()
+            compacted.append(msg if content == msg["content"] else {**msg, "content": content})
+        compacted.reverse()
+        return compacted
+
+    async def _observe(self, messages: List[Dict[str, Any]]) -> str:
+        """Observer: сжать фрагмент диалога в датированные наблюдения.
+
+        Реплики ассистента сжимаются сильнее реплик пользователя: во вход идёт только их начало.
+        """
+        prompt = self._observe_prompt(messages)
+        if not prompt:
+            return ""
+        text = await self._summarize_call(prompt)
+        return _dated(text) if text else ""
+
+    @staticmethod
+    def _observe_prompt(messages: List[Dict[str, Any]]) -> str:
+        """Запрос observer-у; реплики ассистента сжимаются сильнее реплик пользователя (берётся их начало)."""
+        lines: List[str] = []
+        for msg in messages:
+            content = msg.get("content")
+            if not isinstance(content, str):
+                continue
+            role = msg.get("role")
+            if role != "user":
+                content = content[:max(_ASSISTANT_OBSERVE_MIN_CHARS, len(content) // 5)]
+            lines.append(_ROLE_PREFIXES.get(role, _ASSISTANT_PREFIX) + content)
+        return "\n".join([_OBSERVE_PROMPT_HEADER, *lines]) if lines else ""
+
+    async def _reflect(self, summary: str) -> str:
+        """Reflector: пересобрать накопленные наблюдения в компактную сводку."""
+        return await self._summarize_call(_REFLECT_PROMPT_HEADER + summary)
+
+    def _summary_request_body(self, prompt: str) -> Dict[str, Any]:
+        """Параметры запроса на суммаризацию (общие для обычного вызова и Batch API)."""
+        return {
+            "model": self.model,
+            "reasoning": {"effort": "low"},
+            "instructions": _SUMMARIZER_INSTRUCTIONS,
+            "input": [{"role": "user", "content": prompt}],
+            "prompt_cache_key": settings.openai_prompt_cache_key,
+        }
 
-    def create_vector_store(self, name: str) -> str:
+    async def _summarize_call(self, prompt: str) -> str:
+        async with self._sem, self._rpm:
+            response = await self.client.responses.create(**self._summary_request_body(prompt))
+        return (getattr(response, "output_text", "") or "").strip()
+
+    async def create_vector_store(self, name: str) -> str:
         """Создать векторное хранилище, вернуть его id."""
         try:
-            vs = self.client.vector_stores.create(name=name)
+            async with self._sem, self._rpm:
+                vs = await self.client.vector_stores.create(name=name)
             logger.info(f"Создан vector store: {vs.id} ({vs.name})")
             return vs.id
         except Exception as e:
@@ -601,23 +851,69 @@ class OpenAIService:
 
     def set_vector_store(self, vector_store_id: str) -> None:
         self.vector_store_id = vector_store_id
+        # Описание file_search неизменно до следующей смены хранилища — собираем один раз
+        self._file_search_tool: Tuple[Dict[str, Any], ...] = (
+            ({"type": "file_search", "vector_store_ids": [vector_store_id]},) if vector_store_id else ()
+        )
 
-    def upload_pdf(self, file_path: str) -> Optional[str]:
-        """Загрузить PDF в Files и прикрепить к текущему vector store. Возвращает file_id."""
+    async def upload_pdf(self, file_path: str) -> Optional[str]:
+        """Загрузить PDF в Files и прикрепить к текущему vector store. Возвращает file_id.
+
+        Повторная загрузка того же содержимого в течение часа не выполняется — возвращается
+        file_id из кэша по хэшу файла.
+        """
         if not self.vector_store_id:
             raise RuntimeError("Vector store не настроен. Сначала укажите ID хранилища.")
         try:
-            file = self.client.files.create(file=open(file_path, "rb"), purpose="assistants")
-            self.client.vector_stores.files.create(
-                vector_store_id=self.vector_store_id,
-                file_id=file.id,
-            )
-            logger.info(f"Файл {file_path} загружен (file_id={file.id}) и привязан к {self.vector_store_id}")
-            return file.id
+            cache_key, file_id, cached = await self._upload_file(file_path)
+            if cached:
+                return file_id
+            async with self._sem, self._rpm:
+                await self.client.vector_stores.files.create(
+                    vector_store_id=self.vector_store_id,
+                    file_id=file_id,
+                )
+            logger.info(f"Файл {file_path} загружен (file_id={file_id}) и привязан к {self.vector_store_id}")
+            self._remember_pdf(cache_key, file_id)
+            return file_id
         except Exception as e:
             logger.error(f"Ошибка загрузки PDF '{file_path}': {e}")
             return None
 
+    async def _upload_file(self, file_path: str) -> Tuple[Tuple[str, str], str, bool]:
+        """Загрузить PDF в Files (без привязки). Возвращает (ключ кэша, file_id, взят ли из кэша)."""
+        # Хэширование файла — блокирующее чтение с диска, выносим из event loop
+        # (run_in_executor без копирования contextvars, которое делает to_thread)
+        digest = await asyncio.get_running_loop().run_in_executor(None, self._file_digest, file_path)
+        cache_key = (self.vector_store_id, digest)
+        cached = self._pdf_cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] < self._pdf_cache_ttl:
+            logger.info(f"Файл {file_path} уже загружен (file_id={cached[1]}), пропускаем upload")
+            return cache_key, cached[1], True
+
+        with open(file_path, "rb") as f:
+            async with self._sem, self._rpm:
+                file = await self.client.files.create(
+                    file=(os.path.basename(file_path), f, "application/pdf"),
+                    purpose="assistants",
+                )
+        return cache_key, file.id, False
+
+    def _remember_pdf(self, cache_key: Tuple[str, str], file_id: str) -> None:
+        self._pdf_cache[cache_key] = (time.monotonic(), file_id)
+        self._pdf_cache.move_to_end(cache_key)
+        while len(self._pdf_cache) > self._pdf_cache_max:
+            self._pdf_cache.popitem(last=False)
+
+    @staticmethod
+    def _file_digest(file_path: str, chunk_size: int = 1 << 20) -> str:
+        """Быстрый хэш содержимого файла (BLAKE2b, 128 бит)."""
+        h = hashlib.blake2b(digest_size=16)
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
     def _sampling_kwargs(self) -> Dict[str, Any]:
         """Возвращает параметры сэмплинга, если они разрешены и поддерживаются.
 
@@ -0,0 +1,32 @@
+"""
+Общий пул соединений Redis для всего процесса.
+
+Используется и памятью диалогов, и FSM-хранилищем aiogram: один пул,
+один health-check, парсер hiredis (если установлен) и Unix-сокет при REDIS_SOCKET_PATH.
+"""
+from __future__ import annotations
+
+from typing import Any, Dict
+
+from redis import asyncio as aioredis
+
+from app.config import settings
+
+
+def _pool_kwargs() -> Dict[str, Any]:
+    kwargs: Dict[str, Any] = {
+        "max_connections": settings.redis_max_connections,
+        "health_check_interval": 30,
+    }
+    # TCP keepalive не применим к Unix-сокету
+    if not settings.redis_url.startswith("unix://"):
+        kwargs["socket_keepalive"] = True
+    return kwargs
+
+
+redis_pool = aioredis.ConnectionPool.from_url(settings.redis_url, **_pool_kwargs())
+
+
+def get_redis() -> aioredis.Redis:
+    """Клиент Redis поверх общего пула (ответы — bytes)."""
+    return aioredis.Redis(connection_pool=redis_pool)
@@ -0,0 +1,246 @@
+"""
+Отложенная суммаризация через OpenAI Batch API.
+
+Суммаризация истории идёт в фоне и никого не задерживает, поэтому при
+OPENAI_SUMMARY_BATCH_ENABLED запросы копятся в очереди и раз в FLUSH_INTERVAL секунд
+(или при накоплении BATCH_SIZE штук) уходят одним batch-заданием: JSONL в Files API +
+batches.create. Такие запросы вдвое дешевле и не расходуют realtime-лимиты.
+
+Отправленные задания сохраняются в Redis: после перезапуска бота опрос продолжается,
+а не начинается заново. Готовые результаты передаются в on_result; запросы, по которым
+ответа нет (ошибка отправки, ошибка запроса, истёк срок задания), — в on_failed, и вызывающий
+выполняет их обычным запросом. Вместе с запросом хранятся сообщения истории, из которых он собран:
+вызывающий удаляет их из истории только после того, как сводка по ним сохранена.
+"""
+from __future__ import annotations
+
+import asyncio
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import orjson
+from loguru import logger
+from openai import AsyncOpenAI
+from redis import asyncio as aioredis
+
+from app.services.redis_client import get_redis
+
+# (chat_id, текст запроса на суммаризацию, сообщения истории, вошедшие в запрос)
+SummaryJob = Tuple[int | str, str, List[Dict[str, Any]]]
+JobCallback = Callable[[int | str, str, List[Dict[str, Any]]], Awaitable[None]]
+
+
+class SummaryBatchQueue:
+    """Очередь запросов на суммаризацию, отправляемых пакетами через Batch API."""
+
+    BATCH_SIZE = 500
+    FLUSH_INTERVAL = 60.0
+    POLL_INTERVAL = 60.0
+    _FINAL_STATUSES = frozenset({"completed", "failed", "expired", "cancelled"})
+    # HASH: batch_id -> JSON {custom_id: [chat_id, prompt, messages]}
+    _IN_FLIGHT_KEY = "summary_batch:in_flight"
+
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        build_body: Callable[[str], Dict[str, Any]],
+        on_result: JobCallback,
+        on_failed: JobCallback,
+        redis: Optional[aioredis.Redis] = None,
+    ) -> None:
+        """
+        Args:
+            client: Клиент OpenAI
+            build_body: Тело запроса /v1/responses для текста запроса
+            on_result: Вызывается с (chat_id, текст ответа, сообщения) для каждого выполненного запроса
+            on_failed: Вызывается с (chat_id, текст запроса, сообщения) для запросов, оставшихся без ответа
+            redis: Клиент Redis для сохранения отправленных заданий (по умолчанию — общий пул)
+        """
+        self.client = client
+        self.redis = redis if redis is not None else get_redis()
+        self._build_body = build_body
+        self._on_result = on_result
+        self._on_failed = on_failed
+        # None в очереди — сигнал остановки: всё, что пришло до него, будет отправлено
+        self._queue: "asyncio.Queue[Optional[SummaryJob]]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        # batch_id -> задача опроса; _waiting — задания, которые ещё ждут результата
+        self._polls: Dict[str, asyncio.Task] = {}
+        self._waiting: Set[str] = set()
+        # Чаты, по которым запрос ещё не выполнен (в очереди или в отправленном задании)
+        self._pending_chats: Set[int | str] = set()
+
+    def is_pending(self, chat_id: int | str) -> bool:
+        """Есть ли по чату невыполненный запрос."""
+        return chat_id in self._pending_chats
+
+    def enqueue(self, chat_id: int | str, prompt: str, messages: List[Dict[str, Any]]) -> None:
+        """Поставить запрос на суммаризацию в очередь (не блокирует)."""
+        self._pending_chats.add(chat_id)
+        self._queue.put_nowait((chat_id, prompt, messages))
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Остановить очередь: накопленные запросы отправить, опрос отправленных заданий прекратить.
+
+        Сами задания не отменяются: они сохранены в Redis, и после перезапуска опрос продолжится.
+        Задания, результаты которых уже применяются, дорабатывают до конца.
+        """
+        if self._task is not None:
+            self._queue.put_nowait(None)
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for batch_id, poll in list(self._polls.items()):
+            if batch_id in self._waiting:
+                poll.cancel()
+        await asyncio.gather(*self._polls.values(), return_exceptions=True)
+
+    async def _restore(self) -> None:
+        """Возобновить опрос заданий, отправленных до перезапуска."""
+        try:
+            saved = await self.redis.hgetall(self._IN_FLIGHT_KEY)
+        except Exception as e:
+            logger.error(f"Не удалось прочитать незавершённые batch-задания: {e}")
+            return
+        for batch_id, payload in saved.items():
+            batch_id = batch_id.decode("utf-8") if isinstance(batch_id, bytes) else batch_id
+            try:
+                jobs = {custom_id: tuple(job) for custom_id, job in orjson.loads(payload).items()}
+            except (orjson.JSONDecodeError, AttributeError, TypeError) as e:
+                logger.error(f"Повреждённая запись batch {batch_id}: {e}")
+                continue
+            for chat_id, _, _ in jobs.values():
+                self._pending_chats.add(chat_id)
+            self._watch(batch_id, jobs)
+        if saved:
+            logger.info(f"Возобновлён опрос batch-заданий суммаризации: {len(saved)}")
+
+    async def _collect(self) -> Tuple[List[SummaryJob], bool]:
+        """Пакет запросов и признак остановки."""
+        # Ждём первый запрос без таймаута, затем добираем пакет до дедлайна
+        job = await self._queue.get()
+        if job is None:
+            return [], True
+        jobs = [job]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.FLUSH_INTERVAL
+        while len(jobs) < self.BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                job = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if job is None:
+                return jobs, True
+            jobs.append(job)
+        return jobs, False
+
+    async def _submit(self, jobs: List[SummaryJob]) -> None:
+        by_id = {f"{job[0]}:{uuid.uuid4().hex[:12]}": job for job in jobs}
+        data = b"\n".join(
+            orjson.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/responses", "body": self._build_body(prompt)})
+            for custom_id, (_, prompt, _) in by_id.items()
+        )
+        try:
+            input_file = await self.client.files.create(
+                file=("summaries.jsonl", data, "application/jsonl"),
+                purpose="batch",
+            )
+            batch = await self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/responses",
+                completion_window="24h",
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось отправить batch суммаризации ({len(jobs)} шт.): {e}")
+            for chat_id, prompt, messages in jobs:
+                await self._on_failed(chat_id, prompt, messages)
+                self._pending_chats.discard(chat_id)
+            return
+        logger.info(f"Batch суммаризации {batch.id} отправлен ({len(jobs)} шт.)")
+        try:
+            await self.redis.hset(self._IN_FLIGHT_KEY, batch.id, orjson.dumps(by_id))
+        except Exception as e:
+            # Опрос в этом процессе всё равно идёт; при перезапуске задание будет потеряно
+            logger.error(f"Не удалось сохранить batch {batch.id}: {e}")
+        self._watch(batch.id, by_id)
+
+    def _watch(self, batch_id: str, jobs: Dict[str, SummaryJob]) -> None:
+        self._waiting.add(batch_id)
+        task = asyncio.create_task(self._poll(batch_id, jobs))
+        self._polls[batch_id] = task
+        task.add_done_callback(lambda _: self._polls.pop(batch_id, None))
+
+    async def _poll(self, batch_id: str, jobs: Dict[str, SummaryJob]) -> None:
+        """Дождаться завершения batch-задания и применить результаты."""
+        while True:
+            await asyncio.sleep(self.POLL_INTERVAL)
+            try:
+                batch = await self.client.batches.retrieve(batch_id)
+            except Exception as e:
+                logger.debug("Не удалось получить статус batch {}: {}", batch_id, e)
+                continue
+            if batch.status in self._FINAL_STATUSES:
+                break
+
+        results: Dict[str, str] = {}
+        try:
+            if batch.output_file_id:
+                content = await self.client.files.content(batch.output_file_id)
+                results = self._parse_output(content.content)
+            logger.info(f"Batch суммаризации {batch_id}: {batch.status}, готово {len(results)} из {len(jobs)}")
+        except Exception as e:
+            logger.warning(f"Ошибка обработки batch {batch_id}: {e}")
+
+        # Дальше — применение результатов: stop() его не прерывает
+        self._waiting.discard(batch_id)
+        for custom_id, (chat_id, prompt, messages) in jobs.items():
+            text = results.get(custom_id)
+            if text:
+                await self._on_result(chat_id, text, messages)
+            else:
+                await self._on_failed(chat_id, prompt, messages)
+            self._pending_chats.discard(chat_id)
+        try:
+            await self.redis.hdel(self._IN_FLIGHT_KEY, batch_id)
+        except Exception as e:
+            logger.error(f"Не удалось удалить запись batch {batch_id}: {e}")
+
+    @staticmethod
+    def _parse_output(raw: bytes) -> Dict[str, str]:
+        """custom_id -> текст ответа для успешно выполненных запросов из выходного JSONL."""
+        results: Dict[str, str] = {}
+        for line in raw.splitlines():
+            if not line.strip():
+                continue
+            try:
+                item = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+            response = item.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            text = "".join(
+                part.get("text", "")
+                for out in (response.get("body") or {}).get("output") or ()
+                if out.get("type") == "message"
+                for part in out.get("content") or ()
+                if part.get("type") == "output_text"
+            ).strip()
+            if text:
+                results[item.get("custom_id")] = text
+        return results
+
+    async def _run(self) -> None:
+        await self._restore()
+        while True:
+            jobs, stopping = await self._collect()
+            if jobs:
+                await self._submit(jobs)
+            if stopping:
+                return
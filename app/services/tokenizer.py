@@ -3,17 +3,31 @@
 """
 from __future__ import annotations
 
-from typing import Dict, List
+from functools import lru_cache
+from typing import Any, Dict
 
 import tiktoken
 
+# Переоценка на служебные токены/структуру одного сообщения
+_OVERHEAD_PER_MESSAGE = 4
 
+# Кодировка для моделей, которых tiktoken не знает: семейства GPT-4o/5 используют o200k_base
+_FALLBACK_ENCODING = "o200k_base"
+
+
+@lru_cache(maxsize=8)
 def _get_encoding(model: str):
+    # Кодировка резолвится один раз на модель: encoding_for_model + try/except не на каждом вызове
     try:
         return tiktoken.encoding_for_model(model)
     except Exception:
-        # Универсальная кодировка для GPT-4/4o/5 семейств
-        return tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding(_FALLBACK_ENCODING)
+
+
+@lru_cache(maxsize=64)
+def _role_tokens(role: str, model: str) -> int:
+    # Ролей всего несколько (user/assistant/developer/system) — кодируем каждую один раз на модель
+    return len(_get_encoding(model).encode_ordinary(role))
 
 
 def count_text_tokens(text: str, model: str) -> int:
@@ -21,25 +35,21 @@ def count_text_tokens(text: str, model: str) -> int:
     return len(enc.encode(text or ""))
 
 
-def count_messages_tokens(messages: List[Dict[str, str]], model: str) -> int:
-    """Грубая оценка числа токенов для массива сообщений.
+@lru_cache(maxsize=8192)
+def count_message_tokens(role: str, content: str, model: str) -> int:
+    """Оценка токенов одного сообщения (с учётом служебных токенов).
 
-    Замечание: точное число зависит от формата API. Эта функция даёт
-    стабильную верхнюю оценку для контроля бюджета.
+    Результат кэшируется: строки истории повторяются из запроса в запрос.
     """
-    enc = _get_encoding(model)
-    total = 0
-    # Переоценка на служебные токены/структуру
-    overhead_per_message = 4
-    for m in messages:
-        total += overhead_per_message
-        total += len(enc.encode(m.get("role", "")))
-        content = m.get("content", "")
-        if isinstance(content, str):
-            total += len(enc.encode(content))
-        else:
-            # На случай сложных content-структур
-            total += len(enc.encode(str(content)))
-    return total
-
-
+    # encode_ordinary: спецтокены в тексте пользователя считаются как обычный текст, без ValueError
+    content_tokens = len(_get_encoding(model).encode_ordinary(content)) if content else 0
+    return _OVERHEAD_PER_MESSAGE + _role_tokens(role, model) + content_tokens
+
+
+def count_single_message_tokens(message: Dict[str, Any], model: str) -> int:
+    """Оценка токенов одного сообщения-словаря {"role", "content"}."""
+    content = message.get("content", "")
+    # На случай сложных content-структур
+    if not isinstance(content, str):
+        content = str(content)
+    return count_message_tokens(message.get("role", ""), content, model)
@@ -0,0 +1,115 @@
+"""
+Фоновая пакетная запись пользователей в БД.
+
+Middleware кладёт данные пользователя в очередь и сразу продолжает обработку;
+фоновая задача раз в FLUSH_INTERVAL секунд (или при накоплении BATCH_SIZE записей)
+выполняет один INSERT ... ON CONFLICT DO UPDATE на весь пакет.
+"""
+from __future__ import annotations
+
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from aiogram.types import User
+from loguru import logger
+
+from app.database import db
+from app.services.redis_client import get_redis
+
+UserRow = Tuple[int, Optional[str], Optional[str], Optional[str]]
+# Запись и ключ отметки «seen», поставленной middleware перед постановкой в очередь
+QueueItem = Tuple[UserRow, Optional[str]]
+
+
+class UserBatchWriter:
+    """Очередь пользователей и фоновый writer с пакетным upsert."""
+
+    BATCH_SIZE = 100
+    FLUSH_INTERVAL = 0.5
+
+    def __init__(self) -> None:
+        # None в очереди — сигнал остановки: всё, что пришло до него, будет записано
+        self._queue: "asyncio.Queue[Optional[QueueItem]]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def enqueue(self, user: User, seen_key: Optional[str] = None) -> None:
+        """Поставить пользователя в очередь на сохранение (не блокирует).
+
+        seen_key снимается, если запись не удалась: иначе следующий апдейт пользователя
+        не попадёт в очередь до истечения отметки.
+        """
+        self._queue.put_nowait(((user.id, user.username, user.first_name, user.last_name), seen_key))
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Остановить writer и дописать то, что осталось в очереди.
+
+        Вместо отмены задачи отправляем сигнал остановки: пакет, уже набранный в _collect
+        или записываемый в _flush, не теряется.
+        """
+        if self._task is not None:
+            self._queue.put_nowait(None)
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _collect(self) -> Tuple[Dict[int, UserRow], List[str], bool]:
+        """Пакет записей, их ключи «seen» и признак остановки."""
+        batch: Dict[int, UserRow] = {}
+        seen_keys: List[str] = []
+        # Ждём первую запись без таймаута, затем добираем пакет до дедлайна
+        item = await self._queue.get()
+        if item is None:
+            return batch, seen_keys, True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.FLUSH_INTERVAL
+        while True:
+            row, seen_key = item
+            # Дедупликация внутри пакета: ON CONFLICT не может обновить строку дважды
+            batch[row[0]] = row
+            if seen_key:
+                seen_keys.append(seen_key)
+            if len(batch) >= self.BATCH_SIZE:
+                break
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                return batch, seen_keys, True
+        return batch, seen_keys, False
+
+    async def _flush(self, batch: Dict[int, UserRow], seen_keys: List[str]) -> None:
+        if not batch:
+            return
+        try:
+            await db.bulk_upsert_users(batch.values())
+        except Exception as e:
+            logger.error(f"Ошибка пакетного сохранения пользователей ({len(batch)} шт.): {e}")
+            await self._forget_seen(seen_keys)
+
+    @staticmethod
+    async def _forget_seen(seen_keys: List[str]) -> None:
+        """Снять отметки «seen» незаписанных пользователей, чтобы их следующий апдейт повторил запись."""
+        if not seen_keys:
+            return
+        try:
+            await get_redis().delete(*seen_keys)
+        except Exception as e:
+            logger.warning(f"Не удалось снять отметки seen ({len(seen_keys)} шт.): {e}")
+
+    async def _run(self) -> None:
+        while True:
+            batch, seen_keys, stopping = await self._collect()
+            await self._flush(batch, seen_keys)
+            if stopping:
+                return
+
+
+# Глобальный синглтон
+user_batch_writer = UserBatchWriter()